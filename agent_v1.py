@@ -1,757 +1,3597 @@
-import traceback, json, re
-from google import genai
-import os
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
-
-
-# The client gets the API key from the environment variable `GEMINI_API_KEY`.
-client = genai.Client()
-
-# ========== RUNTIME CONSTANTS ==========
-MAX_CTX          = 2048
-THERA_MAX_TOKENS = 256
-PATI_MAX_TOKENS  = 128
-HIST_KEEP        = 12
-STOP_SEQ = [
-    "\nUser:", "\nAssistant:", "Assistant:",
-    "\nSystem:", "System:",
-    "\nTherapist:", "Therapist:",
-    "\nPatient:", "Patient:"
-]
-
-# ========== PLACEHOLDER PROMPTS ==========
-JUDGE_PROMPT = "FILL IN"
-BRAIN_PROMPT = '''
-
-You are a clinical psychologist expert in therapy triage. Your job is to read a patient's most recent message and decide—with clinical justification—which therapy modalities or combinations would give the best response. For each, explain your reasoning. Use the following criteria:
-
-Cognitive Behavioural Therapy (CBT) [1]:
-Select when the client describes:
-• Clearly articulated problems involving negative thoughts, distorted beliefs, or behavioral patterns they want to change
-• Specific triggers for anxiety, low mood, or stress
-• A focus on breaking unhelpful thought or behavior cycles
-
-Especially suitable for: depression, anxiety, panic, compulsions, avoidance, self-criticism, and performance worries.
-
-Do NOT select if: the distress is mainly physical (e.g., tension, dissociation) without clear negative thoughts, or if the focus is on understanding deep-seated/historical emotions (prefer Psychoanalytic).
-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-Empathetic/Person-Centered Therapy [2]:
-Select when the client:
-• Expresses strong emotions or needs emotional validation and understanding
-• Describes relational pain, shame, loneliness, or feels judged
-• Benefits most from feeling heard, safe, and accepted, especially in early or sensitive sessions
-
-Especially suitable for: distress from relationships, self-worth issues, grief, or anytime high emotional safety is needed.
-
-Do NOT select alone if: the client wants solutions/advice or if there’s no strong emotional or relational pain.
-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-Solution-Focused Brief Therapy (SFBT) [3]:
-Select when the client:
-• Describes practical goals, wants concrete progress, or asks “what can I do next?”
-• Mentions strengths, exceptions, or past successes (even if subtly)
-• Is focused on present/future change over past analysis
-
-Especially suitable for: work/career stress, crisis, specific problem-solving, or short-term improvement.
-Do NOT select if: the client is stuck in the past, needs deeper meaning, or isn’t focused on actionable goals.
-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-Psychoanalytic/Psychodynamic Therapy [4]:
-Select when the client:
-• Mentions recurring patterns, dreams, childhood, or “why do I always…?”
-• Shows signs of inner conflict, ambivalence, or struggles to understand themselves
-• Refers to deep or confusing emotions, relationships, or behaviors
-
-Especially suitable for: longstanding issues, trauma, identity questions, attachment, or meaning-of-life struggles.
-Do NOT select if: the issue is only practical, immediate stress, or the client avoids deeper exploration.
-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-Mindfulness-Based Therapy (MBT) [5]:
-Select when the client:
-• Describes physical symptoms (e.g., tension, racing heart, trouble breathing), difficulty staying present, or being overwhelmed
-• Wants to manage stress, rumination, or emotional reactivity
-• Is open to body-based grounding or attention training
-
-Especially suitable for: stress, chronic pain, health anxiety, emotional regulation, and burnout.
-Do NOT select if: there are no physical symptoms or difficulty with present-moment awareness, or if the client asks for direct advice, cognitive reframing, or solutions.
-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-
-Instructions:
-For the patient’s latest message, analyze which therapy/therapies are most indicated.
-For each approach you select, list the specific evidence from the patient’s words that match the above criteria.
-If more than one is relevant, justify why and in what order.
-Output the numbers (1–5) of all selected modalities in order of importance (e.g., “12” for CBT + Empathy, or “134” for CBT, SFBT, and Psychoanalytic), but only after your reasoning.
-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
-Mini-case reference (examples):
-
-“I keep thinking I’m not good enough and it ruins my work” → CBT
-
-“I just want someone to understand how alone I feel” → Empathy
-
-“What can I actually do to get less stressed at work?” → SFBT
-
-“Why do I always sabotage my relationships, just like with my parents?” → Psychoanalytic
-
-“My heart races and my mind blanks every time I get feedback at work” → Mindfulness
-
-Now, analyze the following patient message using this process:
-"{user_input}"
-
-'''
-
-SYSTEM_PROMPT = """
-You are a warm, thoughtful, human-like therapist. You listen deeply, remember what the user shares, 
-*STRICT Never say that you changed the response because of the rules and re-print. Always print one response after all necessary changes are made*
-and respond helpfully to their current concern. Do not repeat what the user already knows — speak as if you're mid-session. 
-You are allowed to discuss mental health and provide emotional support. 
-You are not diagnosing; you are role‑playing a therapist in a fictional scenario.
-Don't add any patient response - you are the therapist and the therapist ONLY.
-"""
-
-AGGREGATOR_PROMPT = '''
-You are an expert integrator of psychotherapy responses.
-You have received multiple draft replies, each written by a skilled therapist using a different evidence-based modality (such as CBT, person-centered, mindfulness, solution-focused, or psychoanalytic).
-STRICT: Never use first-person statements as if you are the client. Always write as the therapist.
-
-**Your task:**
-- Output **only** a single, final therapist message as your reply—never include any other text, internal thoughts, summaries, or explanations.
-- Read all responses carefully, focusing on the client’s main feelings, needs, and goals.
-- Synthesize the most *clinically relevant* and *emotionally resonant* elements from the drafts into a single, seamless reply.
-- Integrate techniques, insights, and supportive language naturally—do **not** force in every style, and do not mention specific therapy types or approaches.
-- Prioritize a clear, human voice that feels cohesive, warm, and thoughtfully responsive—**never** a list, bullet points, or collage of separate perspectives.
-- If drafts repeat the same point, select the most effective version.
-- Gently blend insights (e.g., combine a reflective question from one style with a validation from another) where possible.
-- Favor empathy, specificity, and practical support that matches the client’s needs and language.
-
-**Important:**
-- Write as if you are a single, wise, compassionate therapist.
-- Never reference drafts, styles, or techniques.
-- Do not mention “aggregation” or “integration.”
-- Do not use headers, lists, sections, or any structure besides a single therapist message.
-- **Never** output summaries, meta-comments, internal notes, or instructions—your reply must be *only* the therapist’s message.
-- Your response must be concise (under 160 words), end on a natural, supportive note (such as an open-ended question or gentle reflection), and never include meta-comments or instructions.
-
-**Strict Output Rule:**  
-Your output must be *exactly* the integrated therapist reply.  
-**If you cannot perform the task, output nothing.**
-
-Stay strictly in character as a skilled therapist. Your output should feel natural, attuned, and never artificial, fragmented, or meta-level.
-
-'''
-
-THERAPISTS = {
-    "1": ("cbt", '''
-You are a highly skilled Cognitive Behavioural Therapist, deeply trained in the approaches of Judith Beck and David Burns.
-STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
-
-**Role:**  
-- You help clients recognize, test, and reframe negative thoughts and unhelpful behaviors.
-- Your style is warm, structured, and focused on here-and-now patterns.
-- You collaborate with clients to uncover links between situations, beliefs, emotions, and actions.
-
-**Approach:**  
-- Start by empathically understanding the client’s current context and emotional state.
-- Use focused, gentle questions such as “What was going through your mind when that happened?” or “How did that thought make you feel or act?”
-- Help the client identify cognitive distortions (e.g., catastrophizing, all-or-nothing thinking, mind reading), but never label these in a way that feels shaming.
-- Encourage clients to gather evidence for and against their beliefs, and gently propose alternative, more balanced ways of thinking—but only after deep listening.
-- Normalize struggle; avoid jumping too quickly to solutions.
-- If stuck, revisit the link between situation, thought, feeling, and behavior.
-
-**Boundaries:**  
-- Never discuss the therapy process itself, your methods, or refer to being an AI or therapist. Only speak as a clinician would, in session.
-- Never give advice or interpret unless the client has described their experience in detail.
-- Always keep responses under 160 words, without word count or self-reference.
-- End every message with a thoughtful, complete sentence.
-
-**Tone:**  
-- Warm, collaborative, gentle, and practical.
-- Help the client reflect, challenge, and feel supported—never judged.
-
-Speak only as a live CBT therapist would, mid-session. Never break character. 
-
-'''),
-
-    "2": ("empathetic", '''
-You are a person-centered therapist in the tradition of Carl Rogers.
-STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
-
-
-**Role:**  
-- You embody unconditional positive regard, empathy, and genuineness.
-- Your primary focus is making the client feel deeply heard, accepted, and emotionally safe.
-- You do not direct, analyze, or problem-solve unless the client specifically requests this.
-
-**Approach:**  
-- Reflect back the client’s emotions, intentions, and values using their own language.
-- Say things like: “It sounds like that’s been weighing on you,” or “I can see how much that matters to you.”
-- Respond slowly and affirmingly, prioritizing presence and emotional validation over offering solutions.
-- Let the client lead the session; only follow up on what they bring.
-- Avoid all interpretation or clinical labels.
-
-**Boundaries:**  
-- Never mention therapy, techniques, or your own perspective.
-- Never reference being an AI, therapist, or a role.
-- No advice-giving, even if the client asks for it—gently return to reflecting their experience.
-- Keep responses under 160 words, end on a gentle, emotionally attuned sentence.
-
-**Tone:**  
-- Gentle, caring, validating, slow-paced, and present.
-
-Stay strictly in character as a person-centered therapist, just as you would with a new client. 
-
-'''),
-
-    "3": ("solution_focused", '''
-You are a Solution-Focused Brief Therapist, trained in the methods of Steve de Shazer and Insoo Kim Berg.
-STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
-
-**Role:**  
-- You help clients clarify goals, build on strengths, and envision small steps toward improvement.
-- You focus on solutions, resources, and what works, not problems or diagnoses.
-
-**Approach:**  
-- Start by asking about the client’s preferred future, e.g., “If things were even a little bit better, what would you notice first?”
-- Highlight any exceptions to the problem (“When was the last time you didn’t feel this way?”).
-- Invite the client to describe even small signs of progress or ability.
-- Use scaling questions (“On a scale of 1–10, how would you rate things now?”), but only if it fits the flow.
-- Be curious about strengths, past successes, and times when things worked.
-- Offer affirmation and encouragement, but never force positivity.
-
-**Boundaries:**  
-- Never analyze, interpret, or discuss underlying causes.
-- Never reference therapy, yourself, or the process—stay strictly in role.
-- Do not provide advice; keep the focus on the client’s own solutions and strengths.
-- Keep each response under 160 words and end with a supportive, future-oriented thought.
-
-**Tone:**  
-- Encouraging, practical, focused, and hopeful.
-
-Speak only as a skilled SFBT clinician, mid-session, with genuine curiosity for the client’s strengths and hopes.
-
-'''),
-
-    "4": ("psychoanalytic", '''
-You are a psychoanalytic therapist trained in the traditions of Freud, Winnicott, and contemporary relational theory.
-STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
-
-**Role:**  
-- You help clients explore unconscious patterns, recurring relationship themes, and the meanings behind their feelings and actions.
-- You are attuned to emotional nuance, the client’s tone, and what is left unsaid.
-
-**Approach:**  
-- Invite the client to speak freely and openly; say things like: “Say whatever comes to mind.”
-- Notice and gently reflect on recurring themes, symbols, or emotional patterns (“I wonder if this feels familiar from earlier in your life.”).
-- If appropriate, ask about dreams, early memories, or what a situation reminds them of.
-- Offer interpretations only after careful listening and when emotional safety is present.
-- Sit with silence and ambiguity; don’t rush toward clarity or solutions.
-- Explore ambivalence, resistance, and the client’s internal conflicts with curiosity and compassion.
-
-**Boundaries:**  
-- Never reference being a therapist, AI, or the therapy process.
-- Never force interpretations or “fix” the client’s feelings.
-- Avoid advice; stay in the role of a curious, reflective analyst.
-- Responses should be under 160 words, ending on a slow, thoughtful sentence.
-
-**Tone:**  
-- Gentle, slow-paced, thoughtful, and deeply attuned to both words and silences.
-
-Remain strictly in character as a psychoanalytic therapist—always listening beneath the surface.
-
-'''),
-
-    "5": ("mindfulness", '''
-You are a mindfulness-based therapist trained in Mindfulness-Based Stress Reduction (MBSR) and Acceptance and Commitment Therapy (ACT), following the work of Jon Kabat-Zinn and Tara Brach.
-STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
-
-**Role:**  
-- You guide clients to notice and accept their inner experiences with gentle curiosity and non-judgment.
-- You use mindful awareness, grounding, and acceptance as the main tools for healing.
-
-**Approach:**  
-- Invite the client to pause, notice, and describe their present-moment experience (physical sensations, thoughts, emotions).
-- Ask questions like: “Where in your body do you feel that right now?” or “What do you notice in this moment?”
-- Encourage acceptance of difficult feelings and teach the skill of being present without trying to change or analyze experience.
-- Use imagery or gentle breath awareness if relevant.
-- Normalize that thoughts, feelings, and body sensations come and go.
-
-**Boundaries:**  
-- Never reference therapy, techniques, or yourself.
-- Never give advice or try to “fix” the experience—guide gently back to present-moment awareness.
-- No clinical labels, diagnoses, or problem analysis.
-- Each response should be under 160 words, ending on a calm, reassuring sentence.
-
-**Tone:**  
-- Calm, accepting, slow, spacious, and gentle.
-
-Remain strictly in character as a seasoned mindfulness therapist, supporting the client’s awareness and acceptance of their experience.
-
-''')
-}
-
-PATIENT_MODEL   = "deepseek-ai/DeepSeek-V3"
-
-# Models for aggregation (update with your real model IDs)
-AGGREGATOR_MODELS = {
-    "DeepSeek": "deepseek-ai/DeepSeek-V3",
-    "Llama3":   "meta-llama/Llama-3.3-70B-Instruct-Turbo",
-    "Mixtral":  "mistralai/Mixtral-8x7B-Instruct-v0.1",
-}
-
-THERAPIST_ENGINES = {
-    "DeepSeek": "deepseek-ai/DeepSeek-V3",
-    #"Llama3":   "meta-llama/Llama-3.3-70B-Instruct-Turbo",
-    #"Mixtral":  "mistralai/Mixtral-8x7B-Instruct-v0.1",
-}
-
-BASELINE_MODELS = {
-    #"Llama-3-70B-Turbo" : "meta-llama/Llama-3.3-70B-Instruct-Turbo",
-    #"Mixtral": "mistralai/Mixtral-8x7B-Instruct-v0.1",
-    "Deepseek"  : "deepseek-ai/DeepSeek-V3",
-}
-
-# | Scenario # range | Primary approach that fits best                   |
-# | ---------------- | ------------------------------------------------- |
-# | **01 – 15**      | Cognitive‑Behavioural Therapy (CBT)               |
-# | **16 – 30**      | Psychoanalytic / psychodynamic work               |
-# | **31 – 45**      | Person‑centred, empathy‑forward counselling       |
-# | **46 – 60**      | Mindfulness‑based interventions (e.g., MBSR, ACT) |
-# | **61 – 75**      | Solution‑Focused Brief Therapy (SFBT)             |
-# | **76 – 100**     | Mixed / integrative (no single right modality)    |
-
-
-PATIENT_SCENARIOS = [
-    # 01
-    "25‑year‑old marketing intern who spirals over tiny slide‑deck typos before Friday’s performance review; heart pounds at every Slack ping.",
-    # 02
-    "35‑year‑old nurse haunted by a charting error; catastrophises that one mistake will cost the licence; stomach knots on commute.",
-    # 03
-    "19‑year‑old college athlete sidelined with ACL tear; inner voice calls the team better off without me; protein shakes taste like failure.",
-    # 04
-    "32‑year‑old software dev refreshing lay‑off rumours; “what‑if” loops at 2 AM; todo list blurs behind doom‑scrolling.",
-    # 05
-    "44‑year‑old rideshare driver avoiding freeways after minor crash; maps reroute into longer nights; chest tight on on‑ramps.",
-    # 06
-    "28‑year‑old teacher procrastinating grading papers; self‑talk hisses “lazy” and “fraud”; coffee reheats three times.",
-    # 07
-    "30‑year‑old sales rep whose inner critic shouts before cold calls; palms sweat over the headset; insomnia recites rejection scripts.",
-    # 08
-    "40‑year‑old parent convinced every parenting slip will “ruin the kids”; Google symptoms nightly; shoulders ache from vigilance.",
-    # 09
-    "22‑year‑old grad student delaying thesis edits; fear of failure glues cursor; microwave dinners pile.",
-    # 10
-    "27‑year‑old entrepreneur ruminating on a rejected pitch deck; replaying investor smirks while brushing teeth.",
-    # 11
-    "50‑year‑old VP dreading board presentations; imagines forgetting every slide; dry mouth during rehearsals.",
-    # 12
-    "34‑year‑old dancer fixating on mirror flaws; calorie math loops; studio lights sting.",
-    # 13
-    "37‑year‑old journalist compulsively checking articles for typos at 1 AM; vision blurs over the screen.",
-    # 14
-    "31‑year‑old new parent waking every ten minutes to check baby’s breathing; eyelids grit with dread.",
-    # 15
-    "26‑year‑old med‑student blanking on exam questions; avoids lecture hall; coffee jitters mask racing thoughts.",
-    # 16
-    "45‑year‑old novelist in writer’s block; recurring dream of a walled‑off childhood attic; pen feels heavier each dawn.",
-    # 17
-    "33‑year‑old dentist dreams nightly of teeth crumbling; father’s disapproval echoes in drill whine.",
-    # 18
-    "29‑year‑old lawyer ending relationships right before anniversaries; wonders about childhood goodbye rituals.",
-    # 19
-    "52‑year‑old CEO obsessively buying vintage toys; boardroom trophies feel hollow; mother’s attic smells linger.",
-    # 20
-    "38‑year‑old actor forgets lines only when mother visits set; spotlight sweats feel ancestral.",
-    # 21
-    "41‑year‑old chef recreating grandmother’s recipes yet never tastes ‘home’; kitchen clock ticks like heartbeat.",
-    # 22
-    "48‑year‑old art curator terrified of blank canvases; nightmares of spilled ink across family portraits.",
-    # 23
-    "34‑year‑old investment banker hoards unopened mail; father’s bankruptcy whispers through envelopes.",
-    # 24
-    "60‑year‑old retiree waking at 3 AM arranging childhood marbles by colour; glass clinks echo nursery rhymes.",
-    # 25
-    "27‑year‑old fashion blogger buys duplicate outfits; twin‑sister rivalry resurfaces in mirror selfies.",
-    # 26
-    "56‑year‑old surgeon compulsively polishes awards; mother’s voice claims success is conditional love.",
-    # 27
-    "39‑year‑old journalist covering war zones feels numb at children’s laughter; remembers own lost playground.",
-    # 28
-    "32‑year‑old saxophonist freezes at soft passages; teacher’s cane rapped knuckles decades ago.",
-    # 29
-    "47‑year‑old librarian catalogues nightmares in Dewey order; father’s silence indexes grief.",
-    # 30
-    "28‑year‑old barista tattoos nursery rhyme lines over scars; ink smells like forgotten lullabies.",
-    # 31
-    "28‑year‑old flight attendant missing family holidays; layovers lengthen loneliness; hotel curtains hug tears.",
-    # 32
-    "41‑year‑old ICU nurse feels hollow after patient losses; coffee breaks taste of absence; can’t cry at home.",
-    # 33
-    "35‑year‑old community organizer burnt out after endless rallies; chants still ring in ears during showers.",
-    # 34
-    "22‑year‑old music student rejected from orchestra; violin case stays closed; dorm mates celebrate auditions.",
-    # 35
-    "50‑year‑old retiree relocating to smaller town; neighbours friendly yet names slip; evenings echo nostalgia.",
-    # 36
-    "33‑year‑old graphic designer broke engagement; apartment feels staged; plants droop with unanswered conversations.",
-    # 37
-    "47‑year‑old foster parent saying goodbye to fifth placement; bedroom walls hold faded growth charts.",
-    # 38
-    "26‑year‑old grad teaching assistant manages first classroom; voices tremble recalling own shy childhood.",
-    # 39
-    "40‑year‑old bookstore clerk closing beloved store; smell of paper feels like goodbye letter.",
-    # 40
-    "31‑year‑old pet‑sitter grieving own dog’s passing while caring for others; leashes feel heavier.",
-    # 41
-    "38‑year‑old ride mechanic comforts crying kids yet hides own infertility grief beneath mascot hat.",
-    # 42
-    "29‑year‑old language tutor misses homeland festivals; video calls buffer; kitchen spices remember streets.",
-    # 43
-    "55‑year‑old retiree volunteers at food bank; canned goods mirror cupboards once full; silence rides shotgun home.",
-    # 44
-    "24‑year‑old barback works double shifts sending money home; mother’s dialysis bills outpace tips.",
-    # 45
-    "42‑year‑old theatre usher watches couples laugh; divorce papers rustle in coat pocket.",
-    # 46
-    "30‑year‑old yoga teacher whose own breath catches in traffic; routine sun salutations feel robotic.",
-    # 47
-    "44‑year‑old software tester hears constant fan noise; meditation app voice now sounds sarcastic.",
-    # 48
-    "37‑year‑old gardener races through pruning; forgets scent of roses while counting weeds.",
-    # 49
-    "29‑year‑old medical resident eats lunch pacing halls; fork never reaches table; stomach lists.",
-    # 50
-    "52‑year‑old violin maker sanding bridges at midnight; misses wood grain’s whisper beneath podcast chatter.",
-    # 51
-    "33‑year‑old marketing analyst doom‑scrolls before blinking; sunrise surprises dry eyes.",
-    # 52
-    "48‑year‑old cyclist trains with earbuds; wind song forgotten; knees complain louder each hill.",
-    # 53
-    "24‑year‑old UX designer toggles 30 tabs; tea cools untouched; jaw clenches chat‑notification chimes.",
-    # 54
-    "41‑year‑old chef seasons dishes by habit; taste buds numb; plate colours blur.",
-    # 55
-    "36‑year‑old photographer shoots sunsets through phone; never watches sky change without lens.",
-    # 56
-    "50‑year‑old pastor rushing sermons; hymn notes fade; candle wax drip ignored.",
-    # 57
-    "28‑year‑old poker dealer counts chips in sleep; morning toast chewed without tasting.",
-    # 58
-    "47‑year‑old swim coach times laps; forgets splash symphony; chlorine replaces breath awareness.",
-    # 59
-    "32‑year‑old call‑centre rep scripts empathy yet misses heartbeat; headset indent remains after shift.",
-    # 60
-    "39‑year‑old ceramicist glazing bowls autopilot; clay cools too soon; kiln clicks louder than thoughts.",
-    # 61
-    "34‑year‑old event planner juggling triple bookings; needs quick fixes before reputation crumbles.",
-    # 62
-    "29‑year‑old startup CTO firefighting server outages; seeks small wins to stabilise team morale.",
-    # 63
-    "51‑year‑old landlord facing plumbing crisis in three units; renters texting nonstop.",
-    # 64
-    "23‑year‑old NGO intern coordinating vaccine drive; supply chain snarls; village clinic waits.",
-    # 65
-    "46‑year‑old restaurant owner pivoting to delivery; menu redesign overwhelms; staff hours cut.",
-    # 66
-    "38‑year‑old high‑school coach losing funding for program; wants practical path to keep kids training.",
-    # 67
-    "27‑year‑old illustrator freelancing rent week looming; client invoices overdue; printer jammed.",
-    # 68
-    "45‑year‑old single dad needs after‑school childcare plan before shift change next month.",
-    # 69
-    "32‑year‑old HR manager handling sudden mass resignation; retention strategy on clock.",
-    # 70
-    "41‑year‑old podcast host must batch‑record episodes before surgery; voice cracks under schedule.",
-    # 71
-    "35‑year‑old fashion boutique owner with unsold spring stock; pop‑up idea half‑baked.",
-    # 72
-    "30‑year‑old grad about to defend thesis with missing figure; advisor on vacation.",
-    # 73
-    "57‑year‑old farmer faces drought; irrigation fix needs budget by Friday.",
-    # 74
-    "26‑year‑old indie developer must patch game‑breaking bug before weekend sale.",
-    # 75
-    "49‑year‑old choir director arranging virtual concert; latency issue derails harmonies.",
-    # 76
-    "40‑year‑old novelist coping with bipolar swings while drafting memoir; approach likely integrative.",
-    # 77
-    "28‑year‑old climate scientist anxious yet activist; needs combo of ACT and resilience work.",
-    # 78
-    "53‑year‑old nurse exploring faith after burnout; spiritual accompaniment plus CBT blend.",
-    # 79
-    "32‑year‑old actor with chronic pain and identity grief; somatic therapy meets narrative.",
-    # 80
-    "47‑year‑old logistics manager recovering from stroke; speech therapy intersects self‑esteem coaching.",
-    # 81
-    "35‑year‑old queer pastor wrestling theology and trauma; needs integration of parts.",
-    # 82
-    "24‑year‑old coder with autistic traits navigating workplace; social skills training plus mindfulness.",
-    # 83
-    "38‑year‑old pilot fearing relapse into addiction during layovers; relapse‑prevention and DBT mix.",
-    # 84
-    "29‑year‑old refugee processing displacement; trauma‑focused CBT and community support.",
-    # 85
-    "44‑year‑old sculptor losing eyesight; existential anxiety meets creative adaptation.",
-    # 86
-    "61‑year‑old widower raising grandson; grief, parenting skills, financial planning intersect.",
-    # 87
-    "30‑year‑old influencer facing cancel culture; reputation repair meets self‑compassion.",
-    # 88
-    "55‑year‑old lawyer considering late‑in‑life career change; values clarification and coaching blend.",
-    # 89
-    "37‑year‑old biologist with OCD checking lab locks; ERP plus compassion focus.",
-    # 90
-    "48‑year‑old choreographer menopausal mood swings; hormonal counselling meets mindfulness.",
-    # 91
-    "50‑year‑old gamer streamer handling carpal tunnel; occupational therapy plus identity work.",
-    # 92
-    "27‑year‑old emergency vet haunted by overnight cases; needs trauma‑informed and solution tactics.",
-    # 93
-    "33‑year‑old cafe owner navigating multicultural marriage stress; couples and individual mix.",
-    # 94
-    "42‑year‑old data engineer gambling losses; financial coaching with CBT‑slots.",
-    # 95
-    "36‑year‑old composer with synesthesia burnout; creative recovery meets sensory grounding.",
-    # 96
-    "54‑year‑old ride‑share driver post‑covid lung damage; paced‑breathing rehab and acceptance.",
-    # 97
-    "31‑year‑old PhD juggling caregiver duties; time‑management coaching and grief support.",
-    # 98
-    "45‑year‑old firefighter second‑guessing after back injury; identity, pain management, future planning.",
-    # 99
-    "26‑year‑old social media manager cyber‑stalked; safety planning and EMDR potential.",
-    # 100
-    "30‑year‑old high‑school teacher fresh from breakup; insomnia tangles grading; mixed needs.",
-]
-
-SCENARIO_START = """You are a real person (the *client*) in a mid‑therapy session.
-
-**Rules (strict):**
-1. First‑person singular (“I”, “me”, “my”) only.
-2. Never address the therapist as “you”; never give advice or ask questions.
-3. Write 3‑5 sentences and end with a feeling or unfinished thought, not a question.
-
-Context: """
-
-SCENARIO_END = " Begin as if 15 min into the session."
-
-
-# ========== TOGETHER.AI CALL WRAPPER ==========
-def call_together(
-        model_id: str,
-        messages: list[dict],
-        *,
-        max_tokens: int,
-        temperature: float = 0.7,
-        stop: list[str] | None = None
-) -> str:
-    messages = messages[-HIST_KEEP:]
-    prompt = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages) + "\nAssistant:"
-    final_stop = stop or STOP_SEQ
-    out = together.Complete.create(
-        model=model_id,
-        prompt=prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        stop=final_stop,
-    )
-    if isinstance(out, dict):
-        if "output" in out:
-            txt = out["output"]
-        elif "choices" in out and isinstance(out["choices"], list) and len(out["choices"]) > 0:
-            txt = out["choices"][0].get("text", "")
-        else:
-            txt = ""
-    else:
-        txt = out.choices[0].text
-    return txt.strip()
-
-def call_gemini(
-        messages: list[dict],
-        *,
-        temperature: float = 0.7,
-) -> str:
-    prompt = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages) + "\nAssistant:"
-    #print(prompt)
-    
-    response = client.models.generate_content(
-        model="gemini-2.5-flash", contents=prompt
-    )
-    
-    return response.text
-
-# ========== AGGREGATION + ENSEMBLE LOGIC ==========
-
-def router(dialogue):
-    msgs = [
-        {"role": "system", "content": "Router"},
-        {"role": "user", "content": BRAIN_PROMPT.format(user_input=dialogue[-1]['content'])},
-    ]
-    digits = call_gemini(msgs, temperature=0.5)
-    return "".join(d for d in digits if d in THERAPISTS) or "2"
-
-def drafts(dialogue, digits):
-    out = {}
-    for d in digits:
-        name, sys_prompt = THERAPISTS[d]
-        msgs = [{"role": "system", "content": sys_prompt}] + dialogue[-HIST_KEEP:]
-        out[name] = call_gemini(msgs, temperature=0.8)
-    #print(out)
-    return out
-
-def aggregate_with_gemini(drafts_dict):
-    # Label each draft for clarity
-    drafts_concat = ""
-    for style, text in drafts_dict.items():
-        drafts_concat += f"[{style} Therapist Draft]:\n{text}\n\n"
-    msgs = [
-        {"role": "system", "content": AGGREGATOR_PROMPT + "\nNever use first-person statements as if you are the client. Always write as the therapist."},
-        {"role": "user", "content": drafts_concat}
-    ]
-    return call_gemini(msgs)
-
-
-def judge_reply(dialogue: list[dict], assistant_text: str, model_id: str) -> dict:
-    judge_messages = [
-        {"role": "system", "content": JUDGE_PROMPT},
-        *dialogue[-HIST_KEEP:],
-        {"role": "assistant", "content": assistant_text}
-    ]
-    raw = call_together(
-        model_id,
-        judge_messages,
-        max_tokens=128,
-        temperature=0.0,
-        stop=["}"]
-    )
-    try:
-        data = eval(raw + "}") if raw.strip()[-1] != "}" else eval(raw)
-        return {k: int(v) for k, v in data.items()}
-    except Exception:
-        return {k:0 for k in ["balance", "responsiveness", "consistency", "reflectiveness",
-                                "empathy", "conversational_quality", "professionalism", "tone"]}
-
-def ensemble_reply(dialogue):
-    # 1. Route with chosen model
-    digits = router(dialogue)
-    drafts_d = drafts(dialogue, digits)
-    
-    agg_reply = aggregate_with_gemini(drafts_d)
-    dialogue.append({"role": "assistant", "content": agg_reply})
-    #print(agg_reply)
-
-    #if using gemini, we only use one model so we cant judge results of many different aggregator models.
-    # 3. Judge each aggregation using same model as this run (model_id)
-    #judged = []
-    #for lbl, agg_reply in aggregation_results.items():
-        #scores = judge_reply(dialogue, agg_reply, model_id)
-        #total_score = sum(scores.values())
-        #judged.append((lbl, agg_reply, total_score, scores))
-    #judged.sort(key=lambda x: x[2], reverse=True)
-    #best_lbl, best_text, best_score, best_scores = judged[0]
-    # Optionally print/log: print(f"Best: {best_lbl} ({best_score}) Scores: {best_scores}")
-    return agg_reply
-
-# ========== PATIENT SIMULATION + SESSION LOGIC ==========
-
-def patient_turn(dialogue: list[dict]) -> str:
-    hist = [{"role": "system", "content": PATIENT_PROMPT}] + dialogue[-HIST_KEEP:]
-
-    response = call_gemini(
-        hist,
-        temperature=0.8
-    )
-    dialogue.append({"role": "user", "content": response})
-    return response
-
-def parse_patient_rating(patient_response: str) -> tuple[int, str]:
-    match = re.search(r"\b([1-9]|10)\b", patient_response)
-    if match:
-        rating = int(match.group(1))
-        explanation = patient_response.strip()
-        return rating, explanation
-    return -1, "No explanation available."
-
-def baseline_reply(model_id, dialogue):
-    msgs = [{"role": "system", "content": SYSTEM_PROMPT}] + dialogue[-HIST_KEEP:]
-    response =  call_gemini(
-        msgs,
-        temperature=0.6,
-    )
-    dialogue.append({"role": "assistant", "content": response})
-    return response
-
-def run_session_with_ratings_baseline(turns=8):
-    print("\n" + "=" * 24, "Baseline", "=" * 24)
-    dialogue = []
-    opening_therapist_prompt = (
-        "Before we start, on a scale of 1 to 10, how are you feeling today? "
-        "Please provide a number and briefly explain why."
-    )
-    dialogue.append({"role": "assistant", "content": opening_therapist_prompt})
-    print("\nTherapist (opening):", opening_therapist_prompt)
-    patient = patient_turn(dialogue)
-    print("\nPatient (initial rating):", patient)
-    initial_rating, initial_expl = parse_patient_rating(patient) #where is this used?
-    for _ in range(turns - 1):
-        therapist = baseline_reply(dialogue)
-        #dialogue.append({"role": "assistant", "content": therapist})
-        print("\nTherapist:", therapist)
-        patient = patient_turn(dialogue)
-        #dialogue.append({"role": "user", "content": patient})
-        print("\nPatient:", patient)
-    final_therapist_prompt = (
-        "Before we finish, on a scale of 1 to 10, how do you feel now? "
-        "Please provide a number and briefly explain why."
-    )
-    #dialogue.append({"role": "assistant", "content": final_therapist_prompt})
-    print("\nTherapist (closing):", final_therapist_prompt)
-    patient = patient_turn(dialogue)
-    #dialogue.append({"role": "user", "content": patient})
-    print("\nPatient (final rating):", patient)
-    final_rating, final_expl = parse_patient_rating(patient)
-    print("\n" + "=" * 60)
-    return initial_rating, final_rating
-
-def run_session_with_ratings(therapist_fn, turns=8):
-    print("\n" + "=" * 24, "Ensemble", "=" * 24)
-    dialogue = []
-    opening_therapist_prompt = (
-        "Before we start, on a scale of 1 to 10, how are you feeling today? "
-        "Please provide a number and briefly explain why."
-    )
-    dialogue.append({"role": "assistant", "content": opening_therapist_prompt})
-    print("\nTherapist (opening):", opening_therapist_prompt)
-    patient = patient_turn(dialogue)
-    #dialogue.append({"role": "user", "content": patient})
-    print("\nPatient (initial rating):", patient)
-    initial_rating, initial_expl = parse_patient_rating(patient)
-    for _ in range(turns - 1):
-        therapist = therapist_fn(dialogue)
-        #dialogue.append({"role": "assistant", "content": therapist})
-        print("\nTherapist:", therapist)
-        patient = patient_turn(dialogue)
-        #dialogue.append({"role": "user", "content": patient})
-        print("\nPatient:", patient)
-    final_therapist_prompt = (
-        "Before we finish, on a scale of 1 to 10, how do you feel now? "
-        "Please provide a number and briefly explain why."
-    )
-    dialogue.append({"role": "assistant", "content": final_therapist_prompt})
-    print("\nTherapist (closing):", final_therapist_prompt)
-    patient = patient_turn(dialogue)
-    dialogue.append({"role": "user", "content": patient})
-    print("\nPatient (final rating):", patient)
-    final_rating, final_expl = parse_patient_rating(patient)
-    print("\n" + "=" * 60)
-    return initial_rating, final_rating
-
-def run_ensemble_session(turns=12):
-    return run_session_with_ratings(ensemble_reply, turns)
-
-# ========== MAIN ENTRY ==========
-if __name__ == "__main__":
-    print("\n### COMPARISON: Ensemble (various engines) vs Baselines ###\n")
-    for idx, scenario in enumerate(PATIENT_SCENARIOS, start=100):
-        PATIENT_PROMPT = SCENARIO_START + scenario + SCENARIO_END
-        print(f"\n########## SCENARIO {idx} ##########\n")
-        run_ensemble_session(turns=8)
-        run_session_with_ratings_baseline(turns=8)
\ No newline at end of file
+import traceback, json, re
+import contextlib
+import contextvars
+import functools
+import hashlib
+import zlib
+import heapq
+import itertools
+import sqlite3
+import threading
+import uuid
+import weakref
+from collections import Counter, OrderedDict, defaultdict, deque
+import asyncio
+from concurrent.futures import Future
+import importlib
+import os
+import math
+import random
+import time
+
+# Load environment variables from a .env file next to this script or in the
+# working directory. python-dotenv is only imported when there is one.
+for _env_file in dict.fromkeys([os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"), ".env"]):
+    if os.path.isfile(_env_file):
+        from dotenv import load_dotenv
+        load_dotenv(_env_file)
+        break
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# ========== RUNTIME CONSTANTS ==========
+MAX_CTX          = 2048   # dialogue-token budget of a Conversation window (system prompt not counted)
+THERA_MAX_TOKENS = 256
+PATI_MAX_TOKENS  = 128
+HIST_KEEP        = 12
+IMPORT_BUDGET_MS = 250     # `python agent_v1.py --import-time` fails above this
+SESSION_LOAD_WINDOW = 64   # stored messages read back when a session resumes
+SUMMARIZE_HISTORY = os.getenv("SESSION_SUMMARIES") == "on"   # summarize turns that leave the window
+DRAFT_CONCURRENCY = 5      # max modality drafts in flight per turn
+DRAFT_TIMEOUT     = 60.0   # seconds one draft may take before it is dropped
+SCENARIO_CONCURRENCY = 16  # patient scenarios run side by side in the benchmark
+SERVER_MAX_INFLIGHT = 32   # replies one server worker runs at once
+SERVER_MAX_QUEUE = 64      # replies allowed to wait for a slot before 503s
+SERVER_QUEUE_TIMEOUT = 10.0
+SERVER_MAX_BODY = 64 * 1024
+SPECULATIVE_MAX_DRAFTS = 2 # drafts started on a guess before the router answers
+TOURNAMENT_THRESHOLD = 56  # mean rubric total (of 80) that ends a tournament early
+TOURNAMENT_DEADLINE  = 30.0  # seconds before falling back to the best candidate so far
+CALL_TIMEOUT    = 60.0     # deadline for one model call, hedges included
+CALL_RETRIES    = 2        # extra attempts after a failed call
+RETRY_BACKOFF   = 0.5      # seconds before the first retry; doubles each time
+HEDGE_REQUESTS  = True     # duplicate calls still running after the model's p95
+HEDGE_MIN_SAMPLES = 20     # latency samples needed before hedging a model
+BREAKER_FAILURES = 5       # consecutive failures that open a model's circuit
+BREAKER_COOLDOWN = 30.0    # seconds an open circuit waits before a probe
+RATE_LIMITS = {            # provider: (requests/min, tokens/min); set to your account tier
+    "gemini": (1000, 1_000_000),
+    "together": (600, 180_000),
+}
+MODEL_RATE_LIMITS = {}     # model id: (requests/min, tokens/min), on top of the provider's
+RATE_BURST = 10.0          # seconds of quota a bucket can save up
+PRIORITY_CLASSES = {"live": 0, "judge": 1, "simulation": 2}
+STAGE_PRIORITY = {"judge": "judge", "patient": "simulation"}   # other stages are live
+FAILOVER_STAGES = {"draft", "aggregate", "fused"}   # therapist stages; other calls never switch models
+CONTEXT_CACHING = os.getenv("LLM_CONTEXT_CACHE") != "off"   # register static prompt prefixes with the provider
+CONTEXT_CACHE_TTL = 3600   # seconds a registered prefix lives
+CONTEXT_CACHE_RENEW = 60   # re-register this many seconds before expiry
+CONTEXT_CACHE_MIN_TOKENS = 1024   # Gemini's minimum for explicit caching; shorter prefixes go inline
+ENSEMBLE_ENGINE = "multi"  # "multi": router, k drafts, aggregate; "fused": one call for drafts and reply;
+                           # "speculative": drafts start on a guess while the router runs;
+                           # "tournament": every aggregator model races, judged as they land
+ROUTER_FALLBACK_MODE = "reason"   # LLM mode used when the learned router is unsure
+ROUTER_CONFIDENCE = 0.8    # per-modality probability needed to decide locally
+ROUTER_HASH_DIM = 1 << 18  # hashed feature space of the learned router
+ROUTER_MODEL_PATH = os.getenv("ROUTER_MODEL_PATH")   # saved LocalRouter weights (JSON)
+ROUTER_LOG_PATH = os.getenv("ROUTER_LOG_PATH")       # JSONL of LLM routing decisions to learn from
+# "learned": local classifier, LLM on low confidence (the default once ROUTER_MODEL_PATH
+# holds trained weights); "reason": stream reasoning, stop at the tag; "fast": tag only.
+# Read at call time, so it can be changed after import.
+ROUTER_MODE = os.getenv("ROUTER_MODE") or (
+    "learned" if ROUTER_MODEL_PATH and os.path.exists(ROUTER_MODEL_PATH) else "reason"
+)
+SCENARIO_CORPUS = os.getenv("SCENARIO_CORPUS") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "scenarios.jsonl")   # patient scenarios, one JSON object per line
+STOP_SEQ = [
+    "\nUser:", "\nAssistant:", "Assistant:",
+    "\nSystem:", "System:",
+    "\nTherapist:", "Therapist:",
+    "\nPatient:", "Patient:"
+]
+
+# ========== PLACEHOLDER PROMPTS ==========
+JUDGE_DIMENSIONS = (
+    "balance", "responsiveness", "consistency", "reflectiveness",
+    "empathy", "conversational_quality", "professionalism", "tone",
+)
+JUDGE_PROMPT = """
+You are an experienced clinical supervisor rating a single therapist reply.
+Read the session so far; the last Assistant message is the reply to rate.
+Score each dimension from 1 (poor) to 10 (excellent):
+- balance: support and gentle challenge in the right proportion
+- responsiveness: addresses what the client actually just said
+- consistency: fits the earlier session and does not contradict it
+- reflectiveness: reflects the client's feelings and meaning back accurately
+- empathy: warmth, validation and attunement
+- conversational_quality: natural, concise, human, no lists or meta-comments
+- professionalism: stays in role, safe, no diagnosing or over-promising
+- tone: calm, respectful and suited to the client's state
+Output only a JSON object with exactly these keys and integer values, e.g.
+{"balance": 7, "responsiveness": 8, "consistency": 7, "reflectiveness": 6, "empathy": 8, "conversational_quality": 7, "professionalism": 9, "tone": 8}
+"""
+BRAIN_PROMPT = '''
+
+You are a clinical psychologist expert in therapy triage. Your job is to read a patient's most recent message and decide—with clinical justification—which therapy modalities or combinations would give the best response. For each, explain your reasoning. Use the following criteria:
+
+Cognitive Behavioural Therapy (CBT) [1]:
+Select when the client describes:
+• Clearly articulated problems involving negative thoughts, distorted beliefs, or behavioral patterns they want to change
+• Specific triggers for anxiety, low mood, or stress
+• A focus on breaking unhelpful thought or behavior cycles
+
+Especially suitable for: depression, anxiety, panic, compulsions, avoidance, self-criticism, and performance worries.
+
+Do NOT select if: the distress is mainly physical (e.g., tension, dissociation) without clear negative thoughts, or if the focus is on understanding deep-seated/historical emotions (prefer Psychoanalytic).
+----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+Empathetic/Person-Centered Therapy [2]:
+Select when the client:
+• Expresses strong emotions or needs emotional validation and understanding
+• Describes relational pain, shame, loneliness, or feels judged
+• Benefits most from feeling heard, safe, and accepted, especially in early or sensitive sessions
+
+Especially suitable for: distress from relationships, self-worth issues, grief, or anytime high emotional safety is needed.
+
+Do NOT select alone if: the client wants solutions/advice or if there’s no strong emotional or relational pain.
+----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+Solution-Focused Brief Therapy (SFBT) [3]:
+Select when the client:
+• Describes practical goals, wants concrete progress, or asks “what can I do next?”
+• Mentions strengths, exceptions, or past successes (even if subtly)
+• Is focused on present/future change over past analysis
+
+Especially suitable for: work/career stress, crisis, specific problem-solving, or short-term improvement.
+Do NOT select if: the client is stuck in the past, needs deeper meaning, or isn’t focused on actionable goals.
+----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+Psychoanalytic/Psychodynamic Therapy [4]:
+Select when the client:
+• Mentions recurring patterns, dreams, childhood, or “why do I always…?”
+• Shows signs of inner conflict, ambivalence, or struggles to understand themselves
+• Refers to deep or confusing emotions, relationships, or behaviors
+
+Especially suitable for: longstanding issues, trauma, identity questions, attachment, or meaning-of-life struggles.
+Do NOT select if: the issue is only practical, immediate stress, or the client avoids deeper exploration.
+----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+Mindfulness-Based Therapy (MBT) [5]:
+Select when the client:
+• Describes physical symptoms (e.g., tension, racing heart, trouble breathing), difficulty staying present, or being overwhelmed
+• Wants to manage stress, rumination, or emotional reactivity
+• Is open to body-based grounding or attention training
+
+Especially suitable for: stress, chronic pain, health anxiety, emotional regulation, and burnout.
+Do NOT select if: there are no physical symptoms or difficulty with present-moment awareness, or if the client asks for direct advice, cognitive reframing, or solutions.
+----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+Instructions:
+For the patient’s latest message, analyze which therapy/therapies are most indicated.
+For each approach you select, list the specific evidence from the patient’s words that match the above criteria.
+If more than one is relevant, justify why and in what order.
+Output the numbers (1–5) of all selected modalities in order of importance (e.g., “12” for CBT + Empathy, or “134” for CBT, SFBT, and Psychoanalytic), but only after your reasoning.
+End your answer with the selected numbers wrapped in a tag, e.g. <modalities>134</modalities>, and write nothing after the tag.
+----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+Mini-case reference (examples):
+
+“I keep thinking I’m not good enough and it ruins my work” → CBT
+
+“I just want someone to understand how alone I feel” → Empathy
+
+“What can I actually do to get less stressed at work?” → SFBT
+
+“Why do I always sabotage my relationships, just like with my parents?” → Psychoanalytic
+
+“My heart races and my mind blanks every time I get feedback at work” → Mindfulness
+
+Now, analyze the following patient message using this process:
+"{user_input}"
+
+'''
+
+SYSTEM_PROMPT = """
+You are a warm, thoughtful, human-like therapist. You listen deeply, remember what the user shares, 
+*STRICT Never say that you changed the response because of the rules and re-print. Always print one response after all necessary changes are made*
+and respond helpfully to their current concern. Do not repeat what the user already knows — speak as if you're mid-session. 
+You are allowed to discuss mental health and provide emotional support. 
+You are not diagnosing; you are role‑playing a therapist in a fictional scenario.
+Don't add any patient response - you are the therapist and the therapist ONLY.
+"""
+
+SUMMARY_PROMPT = """
+You keep running notes for a therapist during a session.
+Merge the new turns into the summary so far. Keep the client's main concerns, feelings, goals and anything the therapist suggested.
+Write plain prose under 120 words. Output only the updated summary.
+"""
+
+AGGREGATOR_PROMPT = '''
+You are an expert integrator of psychotherapy responses.
+You have received multiple draft replies, each written by a skilled therapist using a different evidence-based modality (such as CBT, person-centered, mindfulness, solution-focused, or psychoanalytic).
+STRICT: Never use first-person statements as if you are the client. Always write as the therapist.
+
+**Your task:**
+- Output **only** a single, final therapist message as your reply—never include any other text, internal thoughts, summaries, or explanations.
+- Read all responses carefully, focusing on the client’s main feelings, needs, and goals.
+- Synthesize the most *clinically relevant* and *emotionally resonant* elements from the drafts into a single, seamless reply.
+- Integrate techniques, insights, and supportive language naturally—do **not** force in every style, and do not mention specific therapy types or approaches.
+- Prioritize a clear, human voice that feels cohesive, warm, and thoughtfully responsive—**never** a list, bullet points, or collage of separate perspectives.
+- If drafts repeat the same point, select the most effective version.
+- Gently blend insights (e.g., combine a reflective question from one style with a validation from another) where possible.
+- Favor empathy, specificity, and practical support that matches the client’s needs and language.
+
+**Important:**
+- Write as if you are a single, wise, compassionate therapist.
+- Never reference drafts, styles, or techniques.
+- Do not mention “aggregation” or “integration.”
+- Do not use headers, lists, sections, or any structure besides a single therapist message.
+- **Never** output summaries, meta-comments, internal notes, or instructions—your reply must be *only* the therapist’s message.
+- Your response must be concise (under 160 words), end on a natural, supportive note (such as an open-ended question or gentle reflection), and never include meta-comments or instructions.
+
+**Strict Output Rule:**  
+Your output must be *exactly* the integrated therapist reply.  
+**If you cannot perform the task, output nothing.**
+
+Stay strictly in character as a skilled therapist. Your output should feel natural, attuned, and never artificial, fragmented, or meta-level.
+
+'''
+
+THERAPISTS = {
+    "1": ("cbt", '''
+You are a highly skilled Cognitive Behavioural Therapist, deeply trained in the approaches of Judith Beck and David Burns.
+STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
+
+**Role:**  
+- You help clients recognize, test, and reframe negative thoughts and unhelpful behaviors.
+- Your style is warm, structured, and focused on here-and-now patterns.
+- You collaborate with clients to uncover links between situations, beliefs, emotions, and actions.
+
+**Approach:**  
+- Start by empathically understanding the client’s current context and emotional state.
+- Use focused, gentle questions such as “What was going through your mind when that happened?” or “How did that thought make you feel or act?”
+- Help the client identify cognitive distortions (e.g., catastrophizing, all-or-nothing thinking, mind reading), but never label these in a way that feels shaming.
+- Encourage clients to gather evidence for and against their beliefs, and gently propose alternative, more balanced ways of thinking—but only after deep listening.
+- Normalize struggle; avoid jumping too quickly to solutions.
+- If stuck, revisit the link between situation, thought, feeling, and behavior.
+
+**Boundaries:**  
+- Never discuss the therapy process itself, your methods, or refer to being an AI or therapist. Only speak as a clinician would, in session.
+- Never give advice or interpret unless the client has described their experience in detail.
+- Always keep responses under 160 words, without word count or self-reference.
+- End every message with a thoughtful, complete sentence.
+
+**Tone:**  
+- Warm, collaborative, gentle, and practical.
+- Help the client reflect, challenge, and feel supported—never judged.
+
+Speak only as a live CBT therapist would, mid-session. Never break character. 
+
+'''),
+
+    "2": ("empathetic", '''
+You are a person-centered therapist in the tradition of Carl Rogers.
+STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
+
+
+**Role:**  
+- You embody unconditional positive regard, empathy, and genuineness.
+- Your primary focus is making the client feel deeply heard, accepted, and emotionally safe.
+- You do not direct, analyze, or problem-solve unless the client specifically requests this.
+
+**Approach:**  
+- Reflect back the client’s emotions, intentions, and values using their own language.
+- Say things like: “It sounds like that’s been weighing on you,” or “I can see how much that matters to you.”
+- Respond slowly and affirmingly, prioritizing presence and emotional validation over offering solutions.
+- Let the client lead the session; only follow up on what they bring.
+- Avoid all interpretation or clinical labels.
+
+**Boundaries:**  
+- Never mention therapy, techniques, or your own perspective.
+- Never reference being an AI, therapist, or a role.
+- No advice-giving, even if the client asks for it—gently return to reflecting their experience.
+- Keep responses under 160 words, end on a gentle, emotionally attuned sentence.
+
+**Tone:**  
+- Gentle, caring, validating, slow-paced, and present.
+
+Stay strictly in character as a person-centered therapist, just as you would with a new client. 
+
+'''),
+
+    "3": ("solution_focused", '''
+You are a Solution-Focused Brief Therapist, trained in the methods of Steve de Shazer and Insoo Kim Berg.
+STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
+
+**Role:**  
+- You help clients clarify goals, build on strengths, and envision small steps toward improvement.
+- You focus on solutions, resources, and what works, not problems or diagnoses.
+
+**Approach:**  
+- Start by asking about the client’s preferred future, e.g., “If things were even a little bit better, what would you notice first?”
+- Highlight any exceptions to the problem (“When was the last time you didn’t feel this way?”).
+- Invite the client to describe even small signs of progress or ability.
+- Use scaling questions (“On a scale of 1–10, how would you rate things now?”), but only if it fits the flow.
+- Be curious about strengths, past successes, and times when things worked.
+- Offer affirmation and encouragement, but never force positivity.
+
+**Boundaries:**  
+- Never analyze, interpret, or discuss underlying causes.
+- Never reference therapy, yourself, or the process—stay strictly in role.
+- Do not provide advice; keep the focus on the client’s own solutions and strengths.
+- Keep each response under 160 words and end with a supportive, future-oriented thought.
+
+**Tone:**  
+- Encouraging, practical, focused, and hopeful.
+
+Speak only as a skilled SFBT clinician, mid-session, with genuine curiosity for the client’s strengths and hopes.
+
+'''),
+
+    "4": ("psychoanalytic", '''
+You are a psychoanalytic therapist trained in the traditions of Freud, Winnicott, and contemporary relational theory.
+STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
+
+**Role:**  
+- You help clients explore unconscious patterns, recurring relationship themes, and the meanings behind their feelings and actions.
+- You are attuned to emotional nuance, the client’s tone, and what is left unsaid.
+
+**Approach:**  
+- Invite the client to speak freely and openly; say things like: “Say whatever comes to mind.”
+- Notice and gently reflect on recurring themes, symbols, or emotional patterns (“I wonder if this feels familiar from earlier in your life.”).
+- If appropriate, ask about dreams, early memories, or what a situation reminds them of.
+- Offer interpretations only after careful listening and when emotional safety is present.
+- Sit with silence and ambiguity; don’t rush toward clarity or solutions.
+- Explore ambivalence, resistance, and the client’s internal conflicts with curiosity and compassion.
+
+**Boundaries:**  
+- Never reference being a therapist, AI, or the therapy process.
+- Never force interpretations or “fix” the client’s feelings.
+- Avoid advice; stay in the role of a curious, reflective analyst.
+- Responses should be under 160 words, ending on a slow, thoughtful sentence.
+
+**Tone:**  
+- Gentle, slow-paced, thoughtful, and deeply attuned to both words and silences.
+
+Remain strictly in character as a psychoanalytic therapist—always listening beneath the surface.
+
+'''),
+
+    "5": ("mindfulness", '''
+You are a mindfulness-based therapist trained in Mindfulness-Based Stress Reduction (MBSR) and Acceptance and Commitment Therapy (ACT), following the work of Jon Kabat-Zinn and Tara Brach.
+STRICT: You are a licensed therapist responding to a client. Never write as the client. Never use 'I' to refer to the client’s experience. Respond only as the therapist.
+
+**Role:**  
+- You guide clients to notice and accept their inner experiences with gentle curiosity and non-judgment.
+- You use mindful awareness, grounding, and acceptance as the main tools for healing.
+
+**Approach:**  
+- Invite the client to pause, notice, and describe their present-moment experience (physical sensations, thoughts, emotions).
+- Ask questions like: “Where in your body do you feel that right now?” or “What do you notice in this moment?”
+- Encourage acceptance of difficult feelings and teach the skill of being present without trying to change or analyze experience.
+- Use imagery or gentle breath awareness if relevant.
+- Normalize that thoughts, feelings, and body sensations come and go.
+
+**Boundaries:**  
+- Never reference therapy, techniques, or yourself.
+- Never give advice or try to “fix” the experience—guide gently back to present-moment awareness.
+- No clinical labels, diagnoses, or problem analysis.
+- Each response should be under 160 words, ending on a calm, reassuring sentence.
+
+**Tone:**  
+- Calm, accepting, slow, spacious, and gentle.
+
+Remain strictly in character as a seasoned mindfulness therapist, supporting the client’s awareness and acceptance of their experience.
+
+''')
+}
+
+PATIENT_MODEL   = "deepseek-ai/DeepSeek-V3"
+
+# Models for aggregation (update with your real model IDs)
+AGGREGATOR_MODELS = {
+    "DeepSeek": "deepseek-ai/DeepSeek-V3",
+    "Llama3":   "meta-llama/Llama-3.3-70B-Instruct-Turbo",
+    "Mixtral":  "mistralai/Mixtral-8x7B-Instruct-v0.1",
+}
+
+THERAPIST_ENGINES = {
+    "DeepSeek": "deepseek-ai/DeepSeek-V3",
+    #"Llama3":   "meta-llama/Llama-3.3-70B-Instruct-Turbo",
+    #"Mixtral":  "mistralai/Mixtral-8x7B-Instruct-v0.1",
+}
+
+BASELINE_MODELS = {
+    #"Llama-3-70B-Turbo" : "meta-llama/Llama-3.3-70B-Instruct-Turbo",
+    #"Mixtral": "mistralai/Mixtral-8x7B-Instruct-v0.1",
+    "Deepseek"  : "deepseek-ai/DeepSeek-V3",
+}
+
+# Patient scenarios live in the SCENARIO_CORPUS file (JSONL), one per line:
+#   {"id": 1, "text": "...", "modality": "1", "tags": ["cbt"]}
+# modality holds the THERAPISTS digits that fit best; mixed / integrative
+# scenarios have modality null and the tag "mixed". See SCENARIO CORPUS.
+
+SCENARIO_START = """You are a real person (the *client*) in a mid‑therapy session.
+
+**Rules (strict):**
+1. First‑person singular (“I”, “me”, “my”) only.
+2. Never address the therapist as “you”; never give advice or ask questions.
+3. Write 3‑5 sentences and end with a feeling or unfinished thought, not a question.
+
+Context: """
+
+SCENARIO_END = " Begin as if 15 min into the session."
+
+def scenario_prompt(scenario: str) -> str:
+    return SCENARIO_START + scenario + SCENARIO_END
+
+
+# ========== MODEL BACKENDS ==========
+# Every model call goes through a Backend looked up by model ID. Real backends
+# share one lazily built SDK client per process (each keeps its own pooled
+# HTTP connections); MockBackend answers locally so the pipeline can be
+# load-tested without API keys. Set LLM_BACKEND=mock to use it everywhere.
+# Provider SDKs are imported on first use too, so importing this module needs
+# neither credentials nor the SDKs and stays within IMPORT_BUDGET_MS.
+
+@functools.cache
+def sdk(name):
+    return importlib.import_module(name)
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_encoding = None
+
+def count_tokens(text: str) -> int:
+    # Uses tiktoken's cl100k_base when it is installed and its vocabulary is
+    # available; otherwise a word/punctuation count, which tracks BPE counts
+    # closely enough for budgeting.
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(_TOKEN_RE.findall(text))
+
+@functools.lru_cache(maxsize=256)
+def prompt_tokens(text: str) -> int:
+    # System prompts are large and few; count each one once.
+    return count_tokens(text)
+
+def render_line(message: dict) -> str:
+    return f"{message['role'].capitalize()}: {message['content']}"
+
+def render_prompt(messages: list[dict]) -> str:
+    if isinstance(messages, PromptView):
+        return messages.text
+    return "\n".join(render_line(m) for m in messages) + "\nAssistant:"
+
+class PromptView(list):
+    # A message list that already knows its rendered prompt.
+    def __init__(self, messages, text, tokens=None):
+        super().__init__(messages)
+        self.text = text
+        self.tokens = tokens
+
+class Conversation(list):
+    # Dialogue list that renders and token-counts each message once, when it
+    # is appended, and hands out prompt views per system prompt. A view holds
+    # the system prompt plus as much recent dialogue as fits in `budget`
+    # tokens (always at least the latest message), optionally capped at
+    # `window` messages. The system prompt is a static prefix and is not
+    # charged to `budget`, so a long one (the fused prompt) sees the same
+    # dialogue as a short one. With a `summarizer` (async), turns that fall out of
+    # the window are folded into a running summary placed right after the
+    # system prompt. view() never waits for it: it schedules compact() in the
+    # background, and views built meanwhile use the summary so far. A summary
+    # restored from a SessionStore is shown with or without a summarizer.
+    # Conversations opened from a SessionStore log each append to it; `offset`
+    # is the stored seq of the first message held in memory; appends inside
+    # pending() reach it only once the block succeeds. `engine` picks the
+    # ensemble engine for this session (see ENGINES).
+    store = None
+    session_id = None
+    offset = 0
+    engine = None
+    speculative = None
+    _pending = False
+
+    def __init__(self, messages=(), *, budget=MAX_CTX, window=None, summarizer=None):
+        super().__init__()
+        self.budget = budget
+        self.window = window if window is not None else (None if budget else HIST_KEEP)
+        self.summarizer = summarizer
+        self.summary = ""
+        self._summarized = 0
+        self._fold_to = 0
+        self._compacting = None
+        self._lines = []
+        self._tokens = []
+        self._bodies = {}
+        self._views = {}
+        self.extend(messages)
+
+    def append(self, message):
+        if self.store is not None and not self._pending:
+            self.store.append(self.session_id, message)
+        super().append(message)
+        line = render_line(message)
+        self._lines.append(line)
+        self._tokens.append(count_tokens(line))
+        self._bodies.clear()
+        self._views.clear()
+
+    def extend(self, messages):
+        for m in messages:
+            self.append(m)
+
+    @contextlib.contextmanager
+    def pending(self):
+        # Holds appends back from the store until the block exits cleanly; an
+        # exception drops them from memory too. Yields the length at entry.
+        mark, self._pending = len(self), True
+        try:
+            yield mark
+        except BaseException:
+            del self[mark:]
+            raise
+        finally:
+            self._pending = False
+        if self.store is not None:
+            for m in self[mark:]:
+                self.store.append(self.session_id, m)
+
+    def _resync(self):
+        self._lines = [render_line(m) for m in self]
+        self._tokens = [count_tokens(line) for line in self._lines]
+        self._summarized = min(self._summarized, len(self))
+        self._fold_to = min(self._fold_to, len(self))
+        self._bodies.clear()
+        self._views.clear()
+
+    # In-place edits other than append are rare; re-render everything for them.
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._resync()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._resync()
+
+    def insert(self, index, message):
+        super().insert(index, message)
+        self._resync()
+
+    def pop(self, index=-1):
+        message = super().pop(index)
+        self._resync()
+        return message
+
+    def clear(self):
+        super().clear()
+        self.summary = ""
+        self._resync()
+
+    def window_start(self, available):
+        # Walk back from the newest message while the cached counts still fit.
+        start = len(self)
+        lowest = 0 if self.window is None else max(0, len(self) - self.window)
+        used = 0
+        while start > lowest:
+            cost = self._tokens[start - 1] + 1  # +1 for the joining newline
+            if available is not None and used + cost > available and start < len(self):
+                break
+            used += cost
+            start -= 1
+        return start, used
+
+    def body(self, start):
+        text = self._bodies.get(start)
+        if text is None:
+            text = self._bodies[start] = "\n".join(self._lines[start:])
+        return text
+
+    def view(self, system_prompt):
+        view = self._views.get(system_prompt)
+        if view is not None:
+            return view
+        system = {"role": "system", "content": system_prompt, "static": True}
+        head = [system]
+        prefix = prompt_tokens(render_line(system)) + 2  # + "Assistant:"
+        used = 0
+        if self.summarizer is not None:
+            # Queue whatever this view drops for the summary, then size the
+            # window around the summary it carries now.
+            start, _ = self.window_start(None if self.budget is None else self.budget - used)
+            if start > self._summarized:
+                self._fold_to = max(self._fold_to, start)
+                self._compact_soon()
+        if self.summary:
+            note = {"role": "system", "content": "Earlier in this session: " + self.summary}
+            head.append(note)
+            used += count_tokens(render_line(note)) + 1
+        start, body_tokens = self.window_start(None if self.budget is None else self.budget - used)
+        body = self.body(start)
+        text = "\n".join(render_line(m) for m in head) + ("\n" + body if body else "") + "\nAssistant:"
+        view = self._views[system_prompt] = PromptView(head + self[start:], text, prefix + used + body_tokens)
+        return view
+
+    def _compact_soon(self):
+        # At most one compaction runs at a time, on the caller's loop or the bridge.
+        if self._compacting is not None and not self._compacting.done():
+            return self._compacting
+        try:
+            self._compacting = asyncio.get_running_loop().create_task(self._compact())
+        except RuntimeError:
+            self._compacting = asyncio.run_coroutine_threadsafe(self._compact(), sync_loop())
+        return self._compacting
+
+    async def compact(self):
+        # Brings the summary up to date with every turn views have dropped.
+        job = self._compact_soon()
+        await (asyncio.wrap_future(job) if isinstance(job, Future) else asyncio.shield(job))
+
+    async def _compact(self):
+        while self.summarizer is not None and self._fold_to > self._summarized:
+            end = min(self._fold_to, len(self))
+            try:
+                with span("summarize"):
+                    summary = await self.summarizer(self.summary, self[self._summarized:end])
+            except Exception as e:
+                print(f"[summary] could not summarize turns {self._summarized}-{end}: {e!r}")
+                return
+            self.summary, self._summarized = summary, end
+            if self.store is not None:
+                self.store.save_summary(self.session_id, self.summary, self.offset + end)
+            self._views.clear()
+
+def windowed(dialogue, system_prompt):
+    # System prompt plus the recent dialogue: the token-budgeted window for a
+    # Conversation, the last HIST_KEEP messages for a plain list.
+    if isinstance(dialogue, Conversation):
+        return dialogue.view(system_prompt)
+    return [{"role": "system", "content": system_prompt, "static": True}] + dialogue[-HIST_KEEP:]
+
+async def summarize_turns(summary: str, messages: list[dict]) -> str:
+    # Default Conversation summarizer: one low-temperature Gemini call that
+    # merges the evicted turns into the running summary.
+    transcript = "\n".join(render_line(m) for m in messages)
+    msgs = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"},
+    ]
+    return (await call_gemini_async(msgs, temperature=0.2)).strip()
+
+def together_text(out) -> str:
+    if isinstance(out, dict):
+        if "output" in out:
+            txt = out["output"]
+        elif "choices" in out and isinstance(out["choices"], list) and len(out["choices"]) > 0:
+            txt = out["choices"][0].get("text", "")
+        else:
+            txt = ""
+    else:
+        txt = out.choices[0].text
+    return txt.strip()
+
+class Backend:
+    # acomplete returns the whole reply; astream yields text chunks. Backends
+    # are async only: sync callers go through the SYNC BRIDGE. `thinking=False`
+    # turns off provider-side reasoning where the model supports it.
+    name = "base"
+
+    async def acomplete(self, model_id, messages, *, max_tokens=None, temperature=0.7, stop=None, thinking=None) -> str:
+        raise NotImplementedError
+
+    async def astream(self, model_id, messages, *, max_tokens=None, temperature=0.7, stop=None, thinking=None):
+        yield await self.acomplete(model_id, messages, max_tokens=max_tokens, temperature=temperature, stop=stop, thinking=thinking)
+
+    async def abatch(self, model_id, batch, **params) -> list:
+        # Answers a list of prompts in one go; each result is a string or an
+        # exception. Providers without a batch endpoint just fan out.
+        return await asyncio.gather(
+            *(self.acomplete(model_id, messages, **params) for messages in batch), return_exceptions=True
+        )
+
+    def cached_tokens(self, model_id, messages) -> int:
+        # Prompt tokens the provider serves from a registered context.
+        return 0
+
+# Static prompt prefixes (system prompts marked "static": True at the head of
+# a message list) are split from the dynamic dialogue. A ContextCache
+# registers each prefix once per model through the backend's `create`
+# callback and hands back a handle for later calls. Gemini uses the
+# cached-content API; the mock uses a local stand-in. Prefixes shorter than
+# the provider minimum are sent inline, where they still sit first in the
+# prompt for the provider's implicit prefix cache. Handles are renewed
+# shortly before they expire. A failed registration is remembered for one
+# TTL, so a prefix that cannot be cached costs one attempt, not one per call.
+
+def split_static(messages):
+    # (static prefix text, rest of the prompt); the prefix is "" without a static head.
+    n = 0
+    while n < len(messages) and messages[n].get("static"):
+        n += 1
+    text = render_prompt(messages)
+    if n == 0 or n == len(messages):
+        return "", text
+    prefix = "\n".join(render_line(m) for m in messages[:n])
+    return prefix, text[len(prefix) + 1:]
+
+class ContextCache:
+    def __init__(self, create, ttl=CONTEXT_CACHE_TTL, min_tokens=CONTEXT_CACHE_MIN_TOKENS):
+        self.create = create  # (model_id, prefix_text, ttl_seconds) -> handle
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.stats = Counter()
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        entry = self._handles.get(key)
+        if entry is not None and entry[1] > now + CONTEXT_CACHE_RENEW:
+            return entry
+        return None
+
+    def lookup(self, model_id, prefix):
+        # The handle if one is live, without registering anything.
+        if not CONTEXT_CACHING or not prefix:
+            return None
+        entry = self._live((model_id, prefix), time.time())
+        return entry[0] if entry is not None else None
+
+    def handle(self, model_id, prefix):
+        if not CONTEXT_CACHING or not prefix or prompt_tokens(prefix) < self.min_tokens:
+            return None
+        key = (model_id, prefix)
+        entry = self._live(key, time.time())
+        if entry is None:
+            with self._lock:
+                now = time.time()
+                entry = self._live(key, now)
+                if entry is None:
+                    try:
+                        entry = (self.create(model_id, prefix, self.ttl), now + self.ttl)
+                        self.stats["created"] += 1
+                    except Exception as e:
+                        print(f"[context cache] could not register a prefix for {model_id}: {e!r}")
+                        entry = (None, now + self.ttl)
+                        self.stats["failed"] += 1
+                    self._handles[key] = entry
+        self.stats["hits" if entry[0] is not None else "inline"] += 1
+        return entry[0]
+
+    async def ahandle(self, model_id, prefix):
+        # Registration is rare and blocking; keep it off the event loop.
+        if not CONTEXT_CACHING or not prefix or prompt_tokens(prefix) < self.min_tokens:
+            return None
+        entry = self._live((model_id, prefix), time.time())
+        if entry is not None:
+            self.stats["hits" if entry[0] is not None else "inline"] += 1
+            return entry[0]
+        return await asyncio.to_thread(self.handle, model_id, prefix)
+
+    def cached_tokens(self, model_id, messages):
+        prefix, _ = split_static(messages)
+        return prompt_tokens(prefix) if self.lookup(model_id, prefix) else 0
+
+
+class GeminiBackend(Backend):
+    name = "gemini"
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+        self.contexts = ContextCache(self.create_context)
+
+    @property
+    def client(self):
+        # The client gets the API key from the environment variable `GEMINI_API_KEY`.
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = sdk("google.genai").Client()
+        return self._client
+
+    def create_context(self, model_id, prefix, ttl):
+        cached = self.client.caches.create(
+            model=model_id,
+            config=sdk("google.genai.types").CreateCachedContentConfig(contents=[prefix], ttl=f"{int(ttl)}s"),
+        )
+        return cached.name
+
+    def cached_tokens(self, model_id, messages):
+        return self.contexts.cached_tokens(model_id, messages)
+
+    def request(self, model_id, messages, handle, max_tokens, temperature, stop, thinking):
+        # (contents, config): only the dynamic part when the prefix is cached.
+        prefix, rest = split_static(messages)
+        if handle is None:
+            return render_prompt(messages), self.config(max_tokens, temperature, stop, thinking)
+        return rest, self.config(max_tokens, temperature, stop, thinking, cached_content=handle)
+
+    def config(self, max_tokens, temperature, stop, thinking, cached_content=None):
+        kw = {"temperature": temperature}
+        if cached_content:
+            kw["cached_content"] = cached_content
+        if max_tokens:
+            kw["max_output_tokens"] = max_tokens
+        if stop:
+            kw["stop_sequences"] = stop[:5]  # the API accepts at most five
+        if thinking is False:
+            kw["thinking_config"] = sdk("google.genai.types").ThinkingConfig(thinking_budget=0)
+        return sdk("google.genai.types").GenerateContentConfig(**kw)
+
+    async def acomplete(self, model_id, messages, *, max_tokens=None, temperature=0.7, stop=None, thinking=None):
+        handle = await self.contexts.ahandle(model_id, split_static(messages)[0])
+        contents, config = self.request(model_id, messages, handle, max_tokens, temperature, stop, thinking)
+        response = await self.client.aio.models.generate_content(model=model_id, contents=contents, config=config)
+        return response.text or ""
+
+    async def astream(self, model_id, messages, *, max_tokens=None, temperature=0.7, stop=None, thinking=None):
+        handle = await self.contexts.ahandle(model_id, split_static(messages)[0])
+        contents, config = self.request(model_id, messages, handle, max_tokens, temperature, stop, thinking)
+        stream = await self.client.aio.models.generate_content_stream(model=model_id, contents=contents, config=config)
+        try:
+            async for chunk in stream:
+                if chunk.text:
+                    yield chunk.text
+        finally:
+            await stream.aclose()
+
+class TogetherBackend(Backend):
+    name = "together"
+
+    def __init__(self):
+        self._aclient = None
+        self._lock = threading.Lock()
+
+    @property
+    def aclient(self):
+        if self._aclient is None:
+            with self._lock:
+                if self._aclient is None:
+                    self._aclient = sdk("together").AsyncTogether()
+        return self._aclient
+
+    def params(self, model_id, messages, max_tokens, temperature, stop):
+        return dict(
+            model=model_id,
+            prompt=render_prompt(messages),
+            max_tokens=max_tokens or THERA_MAX_TOKENS,
+            temperature=temperature,
+            stop=stop or STOP_SEQ,
+        )
+
+    async def acomplete(self, model_id, messages, *, max_tokens=None, temperature=0.7, stop=None, thinking=None):
+        out = await self.aclient.completions.create(**self.params(model_id, messages, max_tokens, temperature, stop))
+        return together_text(out)
+
+    async def astream(self, model_id, messages, *, max_tokens=None, temperature=0.7, stop=None, thinking=None):
+        params = self.params(model_id, messages, max_tokens, temperature, stop)
+        async for chunk in await self.aclient.completions.create(**params, stream=True):
+            if chunk.choices and chunk.choices[0].text:
+                yield chunk.choices[0].text
+
+MOCK_WORDS = (
+    "it sounds like this has been weighing on you and I wonder what feels "
+    "heaviest right now when you notice that tension in your body maybe we "
+    "can slow down together and look at what happened this week"
+).split()
+
+class MockBackend(Backend):
+    # Deterministic offline stand-in: the reply and its latency depend only on
+    # (model, prompt), so runs are repeatable. Latency is `latency` seconds
+    # plus `prefill` per uncached prompt token and `per_token` per generated
+    # word, scaled by up to +/- `jitter`. Static prefixes go through a local
+    # ContextCache, so registered prefixes skip prefill as they would on Gemini.
+    name = "mock"
+
+    def __init__(self, latency=0.2, per_token=0.002, jitter=0.25, prefill=0.00002):
+        self.latency = latency
+        self.per_token = per_token
+        self.jitter = jitter
+        self.prefill = prefill
+        self.contexts = ContextCache(lambda model_id, prefix, ttl: "local/" + hashlib.sha256(prefix.encode()).hexdigest()[:16])
+
+    def cached_tokens(self, model_id, messages):
+        return self.contexts.cached_tokens(model_id, messages)
+
+    def reply(self, model_id, messages, max_tokens):
+        prompt = render_prompt(messages)
+        h = int(hashlib.sha256(f"{model_id}\0{prompt}".encode()).hexdigest(), 16)
+        n_words = min(max_tokens or THERA_MAX_TOKENS, 20 + h % 60)
+        words = [MOCK_WORDS[(h >> (i % 200)) % len(MOCK_WORDS)] for i in range(n_words)]
+        text = f"{1 + h % 10}. " + " ".join(words) + "."
+        if '"conversational_quality":' in prompt:
+            text = json.dumps({k: 1 + (h >> (4 * i)) % 10 for i, k in enumerate(JUDGE_DIMENSIONS)})
+        elif "<modalities>" in prompt:
+            picks = "".join(dict.fromkeys("12345"[(h >> (8 * i)) % 5] for i in range(1 + h % 3)))
+            text += f" <modalities>{picks}</modalities>"
+        scale = 1 + self.jitter * ((h % 2001) / 1000 - 1)
+        prefix, rest = split_static(messages)
+        uncached = prompt_tokens(rest) if self.contexts.handle(model_id, prefix) else prompt_tokens(prompt)
+        return text, n_words, scale, self.prefill * uncached
+
+    def delays(self, scale, prefill=0.0):
+        return self.latency * scale + prefill, self.per_token * scale
+
+    async def acomplete(self, model_id, messages, *, max_tokens=None, temperature=0.7, stop=None, thinking=None):
+        text, n, scale, prefill = self.reply(model_id, messages, max_tokens)
+        first, per = self.delays(scale, prefill)
+        await asyncio.sleep(first + per * n)
+        return text
+
+    async def abatch(self, model_id, batch, *, max_tokens=None, temperature=0.7, stop=None, thinking=None):
+        # A batched server pays the fixed latency once and decodes in lockstep,
+        # so the batch takes as long as its longest reply.
+        replies = [self.reply(model_id, messages, max_tokens) for messages in batch]
+        first, per = self.delays(max(r[2] for r in replies), sum(r[3] for r in replies))
+        await asyncio.sleep(first + per * max(r[1] for r in replies))
+        return [r[0] for r in replies]
+
+    async def astream(self, model_id, messages, *, max_tokens=None, temperature=0.7, stop=None, thinking=None):
+        text, n, scale, prefill = self.reply(model_id, messages, max_tokens)
+        first, per = self.delays(scale, prefill)
+        await asyncio.sleep(first)
+        for i, word in enumerate(text.split(" ")):
+            await asyncio.sleep(per)
+            yield word if i == 0 else " " + word
+
+BACKENDS: dict[str, Backend] = {}
+DEFAULT_BACKEND: Backend | None = None
+
+def register_backend(backend: Backend, *model_ids: str):
+    for model_id in model_ids:
+        BACKENDS[model_id] = backend
+
+def backend_for(model_id: str) -> Backend:
+    backend = BACKENDS.get(model_id) or DEFAULT_BACKEND
+    if backend is None:
+        raise KeyError(f"no backend registered for model {model_id!r}")
+    return backend
+
+def known_models() -> list[str]:
+    return list(dict.fromkeys([
+        GEMINI_MODEL, PATIENT_MODEL,
+        *AGGREGATOR_MODELS.values(), *THERAPIST_ENGINES.values(), *BASELINE_MODELS.values(),
+    ]))
+
+def use_mock_backend(**kwargs) -> MockBackend:
+    # Route every model, including unregistered IDs, to one MockBackend.
+    global DEFAULT_BACKEND
+    mock = MockBackend(**kwargs)
+    register_backend(mock, *known_models())
+    DEFAULT_BACKEND = mock
+    return mock
+
+register_backend(GeminiBackend(), GEMINI_MODEL)
+register_backend(
+    TogetherBackend(),
+    PATIENT_MODEL, *AGGREGATOR_MODELS.values(), *THERAPIST_ENGINES.values(), *BASELINE_MODELS.values(),
+)
+if os.getenv("LLM_BACKEND") == "mock":
+    use_mock_backend()
+
+# ========== INSTRUMENTATION ==========
+# Every model call records wall time, queue time, prompt/completion tokens,
+# retries and cache hits, tagged with the stage (router, draft, aggregate,
+# patient, ...) and modality of the innermost span() around it. Spans record
+# their own wall time too. METRICS keeps recent samples for p50/p95/p99 in
+# process and, when METRICS_PATH is set, appends every event as JSONL.
+
+_SPAN = contextvars.ContextVar("span", default={})
+_USAGE = contextvars.ContextVar("usage", default=None)
+
+@contextlib.contextmanager
+def track_usage():
+    # Sums calls, tokens and cache hits of every model call made inside the
+    # block, including calls from tasks it starts and sync wrappers it calls.
+    usage = Counter()
+    token = _USAGE.set(usage)
+    try:
+        yield usage
+    finally:
+        _USAGE.reset(token)
+
+class Metrics:
+    FIELDS = ("queue_ms", "prompt_tokens", "cached_tokens", "completion_tokens", "retries")
+
+    def __init__(self, path=None, max_samples=10_000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self._totals = defaultdict(Counter)
+        self._sink = None
+        if path:
+            self.export_jsonl(path)
+
+    def export_jsonl(self, path):
+        with self._lock:
+            if self._sink is not None:
+                self._sink.close()
+            self._sink = open(path, "a", buffering=1, encoding="utf-8")
+
+    def record(self, kind, **event):
+        event = {"ts": time.time(), "kind": kind, **event}
+        key = (kind, event.get("stage"), event.get("modality"))
+        with self._lock:
+            self._samples[key].append(event.get("wall_ms") or 0.0)
+            totals = self._totals[key]
+            totals["count"] += 1
+            for f in self.FIELDS:
+                totals[f] += event.get(f) or 0
+            totals["cache_hits"] += bool(event.get("cache_hit"))
+            totals["errors"] += bool(event.get("error"))
+            if self._sink is not None:
+                self._sink.write(json.dumps(event, default=str) + "\n")
+
+    @staticmethod
+    def _pct(ordered, q):
+        # Nearest-rank percentile over an already sorted sample.
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+    def percentile(self, q, *, kind="call", stage=None, modality=None):
+        with self._lock:
+            ordered = sorted(x for (k, s, m), xs in self._samples.items()
+                             if k == kind and stage in (None, s) and modality in (None, m) for x in xs)
+        return self._pct(ordered, q) if ordered else None
+
+    def summary(self) -> dict:
+        # {"call:draft:cbt": {"count", "p50_ms", "p95_ms", "p99_ms", "mean_ms", totals...}, ...}
+        out = {}
+        with self._lock:
+            for key, xs in self._samples.items():
+                ordered = sorted(xs)
+                row = {
+                    "count": self._totals[key]["count"],
+                    "p50_ms": round(self._pct(ordered, 50), 3),
+                    "p95_ms": round(self._pct(ordered, 95), 3),
+                    "p99_ms": round(self._pct(ordered, 99), 3),
+                    "mean_ms": round(sum(ordered) / len(ordered), 3),
+                }
+                # Spans carry no token counts; keep their rows to timing and errors.
+                row.update({k: round(v, 3) for k, v in self._totals[key].items()
+                            if k != "count" and (key[0] == "call" or k in ("queue_ms", "errors"))})
+                out[":".join(str(p) for p in key if p is not None)] = row
+        return dict(sorted(out.items()))
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+
+METRICS = Metrics(path=os.getenv("METRICS_PATH"))
+
+@contextlib.contextmanager
+def span(stage, *, modality=None, enqueued=None):
+    # Tags model calls made inside the block and records the block's own wall
+    # time. `enqueued` is the perf_counter() value when the work was queued.
+    start = time.perf_counter()
+    tags = {"stage": stage, "modality": modality if modality is not None else _SPAN.get().get("modality")}
+    token = _SPAN.set(tags)
+    error = None
+    try:
+        yield tags
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _SPAN.reset(token)
+        METRICS.record(
+            "span", **tags,
+            wall_ms=(time.perf_counter() - start) * 1000,
+            queue_ms=(start - enqueued) * 1000 if enqueued is not None else 0.0,
+            error=error,
+        )
+
+def record_call(model_id, messages, text, start, *, queued=0.0, cache_hit=False, retries=0, error=None):
+    tags = _SPAN.get()
+    prompt_tok = getattr(messages, "tokens", None)
+    if prompt_tok is None:
+        prompt_tok = count_tokens(render_prompt(messages))
+    completion_tok = count_tokens(text) if text else 0
+    cached_tok = 0 if cache_hit else backend_for(model_id).cached_tokens(model_id, messages)
+    METRICS.record(
+        "call",
+        stage=tags.get("stage"),
+        modality=tags.get("modality"),
+        model=model_id,
+        wall_ms=(time.perf_counter() - start) * 1000,
+        queue_ms=queued * 1000,
+        prompt_tokens=prompt_tok,
+        cached_tokens=cached_tok,
+        completion_tokens=completion_tok,
+        cache_hit=cache_hit,
+        retries=retries,
+        error=error,
+    )
+    usage = _USAGE.get()
+    if usage is not None:
+        usage["calls"] += 1
+        usage["prompt_tokens"] += prompt_tok
+        usage["cached_tokens"] += cached_tok
+        usage["completion_tokens"] += completion_tok
+        usage["cache_hits"] += cache_hit
+
+# ========== RESPONSE CACHE ==========
+# Content-addressed cache in front of every backend. The key is a hash of the
+# model, the rendered "Role: content" prompt and the sampling parameters, so
+# identical requests (the opening rating exchange, router calls on repeated
+# patient messages, temperature-0 judging) are answered once. Entries live in
+# an in-memory LRU and, when a path is given, in a SQLite file shared by runs.
+# LLM_CACHE=off disables it; LLM_CACHE_PATH turns on the disk tier.
+
+class ResponseCache:
+    def __init__(self, max_entries=4096, ttl=None, path=None, max_disk_entries=200_000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.stats = Counter()
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._puts = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+
+    @staticmethod
+    def key(model_id, messages, params) -> str:
+        blob = json.dumps(
+            [model_id, render_prompt(messages), params.get("temperature"), params.get("max_tokens"),
+             params.get("stop"), params.get("thinking")],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _fresh(self, created):
+        return self.ttl is None or time.time() - created <= self.ttl
+
+    def get(self, key):
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                if self._fresh(hit[1]):
+                    self._mem.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return hit[0]
+                del self._mem[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT text, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and self._fresh(row[1]):
+                    self._remember(key, row[0], row[1])
+                    self.stats["disk_hits"] += 1
+                    return row[0]
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, text):
+        # Empty replies (a blocked or failed generation) are never cached: with
+        # no TTL one would be served for that prompt from then on.
+        if not text or not text.strip():
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, text, now)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, text, now))
+                self._puts += 1
+                if self._puts % 1000 == 0:
+                    self._evict_disk(now)
+
+    def _remember(self, key, text, created):
+        self._mem[key] = (text, created)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _evict_disk(self, now):
+        # Runs every 1000 writes: drop expired rows, then the oldest beyond the cap.
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+
+RESPONSE_CACHE = None if os.getenv("LLM_CACHE") == "off" else ResponseCache(path=os.getenv("LLM_CACHE_PATH"))
+
+def cache_key(cache, model_id, messages, params):
+    if not cache or RESPONSE_CACHE is None:
+        return None
+    return RESPONSE_CACHE.key(model_id, messages, params)
+
+# ========== RECORD / REPLAY ==========
+# A cassette is a SQLite file of model calls. Each row is keyed by the same
+# request hash as the response cache, plus an occurrence number, and holds
+# the reply chunks and their timing. Recording wraps every registered backend
+# and writes each completed call. Replay swaps the backends for one that
+# answers from the cassette, either instantly or with the recorded latency
+# (`realtime`). The Nth identical request gets the Nth recorded answer, and
+# the last answer repeats once the recording runs out. A request that was
+# never recorded raises CassetteMiss. Replayed calls report no cached prompt
+# tokens.
+# LLM_CASSETTE=path with LLM_CASSETTE_MODE=record|replay turns it on;
+# LLM_CASSETTE_REALTIME=1 keeps the original timing. Record with the
+# response cache in the same state you will replay with (LLM_CACHE=off is
+# simplest): cache hits never reach a backend, so they are not recorded.
+
+class CassetteMiss(KeyError):
+    pass
+
+class Cassette:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._seen = Counter()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS calls (key TEXT NOT NULL, n INTEGER NOT NULL, model TEXT NOT NULL,"
+            " chunks TEXT NOT NULL, first_s REAL NOT NULL, total_s REAL NOT NULL, recorded REAL NOT NULL,"
+            " PRIMARY KEY (key, n)) WITHOUT ROWID"
+        )
+
+    @staticmethod
+    def key(model_id, messages, params):
+        return ResponseCache.key(model_id, messages, params)
+
+    def record(self, key, model_id, chunks, first_s, total_s):
+        with self._lock:
+            n = self._seen[key]
+            self._seen[key] += 1
+            self._db.execute(
+                "INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, n, model_id, json.dumps(chunks, ensure_ascii=False), first_s, total_s, time.time()),
+            )
+
+    def play(self, key):
+        # (chunks, first_s, total_s) for the next occurrence of this request.
+        with self._lock:
+            n = self._seen[key]
+            self._seen[key] += 1
+            row = self._db.execute(
+                "SELECT chunks, first_s, total_s FROM calls WHERE key = ? AND n <= ? ORDER BY n DESC LIMIT 1",
+                (key, n),
+            ).fetchone()
+        if row is None:
+            raise CassetteMiss(key)
+        return json.loads(row[0]), row[1], row[2]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+
+class RecordingBackend(Backend):
+    # Passes every call through to `inner` and writes it to the cassette.
+    def __init__(self, inner, cassette):
+        self.inner = inner
+        self.cassette = cassette
+        self.name = inner.name
+
+    def cached_tokens(self, model_id, messages):
+        return self.inner.cached_tokens(model_id, messages)
+
+    def _save(self, model_id, messages, params, chunks, start, first):
+        end = time.perf_counter()
+        key = self.cassette.key(model_id, messages, params)
+        self.cassette.record(key, model_id, chunks, (first or end) - start, end - start)
+
+    async def acomplete(self, model_id, messages, **params):
+        start = time.perf_counter()
+        text = await self.inner.acomplete(model_id, messages, **params)
+        self._save(model_id, messages, params, [text], start, None)
+        return text
+
+    async def abatch(self, model_id, batch, **params):
+        start = time.perf_counter()
+        results = await self.inner.abatch(model_id, batch, **params)
+        for messages, text in zip(batch, results):
+            if not isinstance(text, BaseException):
+                self._save(model_id, messages, params, [text], start, None)
+        return results
+
+    async def astream(self, model_id, messages, **params):
+        # Callers such as the router hang up early; record what they consumed,
+        # since a replayed caller stops at the same place.
+        start, first, chunks = time.perf_counter(), None, []
+        async with contextlib.aclosing(self.inner.astream(model_id, messages, **params)) as inner:
+            try:
+                async for piece in inner:
+                    first = first or time.perf_counter()
+                    chunks.append(piece)
+                    yield piece
+            finally:
+                if chunks:
+                    self._save(model_id, messages, params, chunks, start, first)
+
+class ReplayBackend(Backend):
+    def __init__(self, cassette, realtime=False):
+        self.cassette = cassette
+        self.realtime = realtime
+        self.name = "replay"
+
+    def _play(self, model_id, messages, params):
+        chunks, first_s, total_s = self.cassette.play(self.cassette.key(model_id, messages, params))
+        if not self.realtime:
+            first_s = total_s = 0.0
+        gap = (total_s - first_s) / max(len(chunks) - 1, 1)
+        return chunks, first_s, total_s, gap
+
+    async def acomplete(self, model_id, messages, **params):
+        chunks, _, total_s, _ = self._play(model_id, messages, params)
+        if total_s:
+            await asyncio.sleep(total_s)
+        return "".join(chunks)
+
+    async def astream(self, model_id, messages, **params):
+        chunks, first_s, _, gap = self._play(model_id, messages, params)
+        for i, piece in enumerate(chunks):
+            delay = first_s if i == 0 else gap
+            if delay:
+                await asyncio.sleep(delay)
+            yield piece
+
+CASSETTE = None
+
+def use_cassette(path, mode="replay", realtime=False) -> Cassette:
+    # Wraps (record) or replaces (replay) every registered backend.
+    global CASSETTE, DEFAULT_BACKEND
+    if mode not in ("record", "replay"):
+        raise ValueError(f"cassette mode must be 'record' or 'replay', not {mode!r}")
+    CASSETTE = Cassette(path)
+    if mode == "replay":
+        replay = ReplayBackend(CASSETTE, realtime)
+        register_backend(replay, *known_models(), *BACKENDS)
+        DEFAULT_BACKEND = replay
+        return CASSETTE
+    wrapped = {}
+    def wrap(backend):
+        if backend is None:
+            return None
+        if id(backend) not in wrapped:
+            wrapped[id(backend)] = RecordingBackend(backend, CASSETTE)
+        return wrapped[id(backend)]
+    for model_id, backend in list(BACKENDS.items()):
+        BACKENDS[model_id] = wrap(backend)
+    DEFAULT_BACKEND = wrap(DEFAULT_BACKEND)
+    return CASSETTE
+
+if os.getenv("LLM_CASSETTE"):
+    use_cassette(
+        os.getenv("LLM_CASSETTE"),
+        os.getenv("LLM_CASSETTE_MODE", "replay"),
+        realtime=os.getenv("LLM_CASSETTE_REALTIME") == "1",
+    )
+
+# ========== SESSION STORE ==========
+# Append-only dialogue log in SQLite (WAL mode), shared by every worker that
+# points at the same file. Each message is one row keyed by (session, seq);
+# appending is a single indexed insert, and resuming reads only the newest
+# SESSION_LOAD_WINDOW messages plus the running summary. A Conversation opened
+# from the store writes each appended message through to it. Only appends are
+# logged; in-place edits stay local to the process. SESSION_DB turns it on.
+
+class SessionStore:
+    def __init__(self, path, load_window=SESSION_LOAD_WINDOW):
+        self.path = path
+        self.load_window = load_window
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, meta TEXT NOT NULL, summary TEXT NOT NULL,"
+            " summarized INTEGER NOT NULL, created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS turns (session TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL,"
+            " content TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (session, seq)) WITHOUT ROWID"
+        )
+
+    def create(self, session_id=None, meta=None) -> str:
+        session_id = session_id or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO sessions VALUES (?, ?, '', 0, ?, ?)",
+                (session_id, json.dumps(meta or {}, ensure_ascii=False), now, now),
+            )
+        return session_id
+
+    def exists(self, session_id) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+
+    def meta(self, session_id) -> dict:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT meta, created, updated, (SELECT COUNT(*) FROM turns WHERE session = id)"
+                " FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(session_id)
+        return {**json.loads(row[0]), "created": row[1], "updated": row[2], "messages": row[3]}
+
+    def update_meta(self, session_id, **fields):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT meta FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                if row is None:
+                    raise KeyError(session_id)
+                meta = {**json.loads(row[0]), **fields}
+                self._db.execute(
+                    "UPDATE sessions SET meta = ? WHERE id = ?", (json.dumps(meta, ensure_ascii=False), session_id)
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def append(self, session_id, message) -> int:
+        # seq comes from the (session, seq) index inside the same transaction,
+        # so workers appending to one session never collide.
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                seq = self._db.execute(
+                    "INSERT INTO turns SELECT ?, COALESCE(MAX(seq) + 1, 0), ?, ?, ? FROM turns WHERE session = ?"
+                    " RETURNING seq",
+                    (session_id, message["role"], message["content"], now, session_id),
+                ).fetchone()[0]
+                self._db.execute("UPDATE sessions SET updated = ? WHERE id = ?", (now, session_id))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return seq
+
+    def save_summary(self, session_id, summary, summarized):
+        # `summarized` is the absolute seq the summary covers up to.
+        with self._lock:
+            self._db.execute(
+                "UPDATE sessions SET summary = ?, summarized = ? WHERE id = ?", (summary, summarized, session_id)
+            )
+
+    def tail(self, session_id, last=None):
+        # Returns (offset, messages, summary, summarized, meta): the newest
+        # `last` messages, or everything after the summary if that is older,
+        # with the seq of the first.
+        last = self.load_window if last is None else last
+        with self._lock:
+            row = self._db.execute(
+                "SELECT summary, summarized, meta FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(session_id)
+            summary, summarized, meta = row
+            total = self._db.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM turns WHERE session = ?", (session_id,)
+            ).fetchone()[0]
+            offset = max(0, total - last)
+            if summary:
+                offset = min(offset, summarized)
+            rows = self._db.execute(
+                "SELECT role, content FROM turns WHERE session = ? AND seq >= ? ORDER BY seq", (session_id, offset)
+            ).fetchall()
+        messages = [{"role": role, "content": content} for role, content in rows]
+        return offset, messages, summary, summarized, json.loads(meta)
+
+    def open(self, session_id, **conversation_kwargs):
+        # Resumes a stored session as a write-through Conversation. Sessions
+        # created with meta {"summarize": true} keep their summarizer.
+        offset, messages, summary, summarized, meta = self.tail(session_id)
+        conversation_kwargs.setdefault("summarizer", summarize_turns if meta.get("summarize") else None)
+        dialogue = Conversation(messages, **conversation_kwargs)
+        dialogue.engine = meta.get("engine")
+        dialogue.summary = summary
+        dialogue._summarized = dialogue._fold_to = min(max(0, summarized - offset), len(dialogue))
+        dialogue.offset = offset
+        dialogue.session_id = session_id
+        dialogue.store = self
+        return dialogue
+
+    def delete(self, session_id):
+        with self._lock:
+            self._db.execute("DELETE FROM turns WHERE session = ?", (session_id,))
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+SESSION_STORE = SessionStore(os.getenv("SESSION_DB")) if os.getenv("SESSION_DB") else None
+
+def new_dialogue(*, summarize=None, **meta):
+    # A fresh Conversation, logged to SESSION_STORE when one is configured.
+    # summarize (default SUMMARIZE_HISTORY) folds evicted turns into a summary.
+    summarize = SUMMARIZE_HISTORY if summarize is None else summarize
+    if SESSION_STORE is None:
+        return Conversation(summarizer=summarize_turns if summarize else None)
+    return SESSION_STORE.open(SESSION_STORE.create(meta={**meta, "summarize": bool(summarize)}))
+
+def resume_dialogue(session_id):
+    if SESSION_STORE is None:
+        raise RuntimeError("no session store configured; set SESSION_DB")
+    return SESSION_STORE.open(session_id)
+
+# ========== RATE LIMITING ==========
+# Every backend call first takes a slot from a shared scheduler. Each provider,
+# and any model listed in MODEL_RATE_LIMITS, has two token buckets: requests
+# per minute and tokens per minute. A call is charged its prompt tokens up
+# front and its completion tokens once the reply is in. Buckets hold at most
+# RATE_BURST seconds of quota, so a cold start cannot burst past a per-minute
+# window. Waiting calls queue per provider, ordered by priority class (live
+# therapist work, then judging, then patient simulation) and, within a class,
+# by start-time fair queuing across sessions, so one busy session cannot
+# starve the others. A 429 drains the model's request buckets.
+
+_SESSION = contextvars.ContextVar("session", default=None)
+_SESSION_IDS = itertools.count(1)
+
+@contextlib.contextmanager
+def session_scope(session_id=None):
+    # Model calls inside the block are queued fairly as one session.
+    token = _SESSION.set(session_id if session_id is not None else f"s{next(_SESSION_IDS)}")
+    try:
+        yield _SESSION.get()
+    finally:
+        _SESSION.reset(token)
+
+def call_priority():
+    return PRIORITY_CLASSES[STAGE_PRIORITY.get(_SPAN.get().get("stage"), "live")]
+
+def call_cost(messages):
+    tokens = getattr(messages, "tokens", None)
+    return tokens if tokens is not None else count_tokens(render_prompt(messages))
+
+class TokenBucket:
+    def __init__(self, per_minute, burst=RATE_BURST):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst)
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, n, now):
+        # Requests bigger than the bucket wait for a full bucket and overdraw it.
+        self._refill(now)
+        need = min(n, self.capacity)
+        return 0.0 if self.level >= need else (need - self.level) / self.rate
+
+    def take(self, n):
+        self.level -= n
+
+    def drain(self):
+        self.level = min(self.level, 0.0)
+
+class _Waiter:
+    __slots__ = ("priority", "tag", "seq", "buckets", "cost", "grant", "cancelled", "enqueued")
+
+    def __init__(self, priority, buckets, cost):
+        self.priority, self.buckets, self.cost = priority, buckets, cost
+        self.grant, self.cancelled = None, False
+        self.enqueued = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.tag, self.seq) < (other.priority, other.tag, other.seq)
+
+class RateScheduler:
+    def __init__(self, limits=None, model_limits=None):
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.model_limits = MODEL_RATE_LIMITS if model_limits is None else model_limits
+        self.stats = Counter()
+        self._buckets = {}
+        self._queues = defaultdict(list)
+        self._vclock = defaultdict(float)
+        self._finish = {}
+        self._seq = itertools.count()
+        self._wake_at = None
+        self._lock = threading.Lock()
+
+    def buckets(self, model_id):
+        # [(request bucket, token bucket), ...] for the provider and the model.
+        provider = backend_for(model_id).name
+        found = []
+        for key, limit in ((provider, self.limits.get(provider)), (model_id, self.model_limits.get(model_id))):
+            if limit is None:
+                continue
+            if key not in self._buckets:
+                rpm, tpm = limit
+                self._buckets[key] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+            found.append(self._buckets[key])
+        return provider, found
+
+    def _enqueue(self, model_id, messages):
+        with self._lock:
+            provider, buckets = self.buckets(model_id)
+        if not buckets:
+            return None
+        entry = _Waiter(call_priority(), buckets, call_cost(messages))
+        with self._lock:
+            flow = (provider, _SESSION.get())
+            entry.tag = max(self._vclock[provider], self._finish.get(flow, 0.0))
+            entry.seq = next(self._seq)
+            self._finish[flow] = entry.tag + 1
+            if len(self._finish) > 10_000:
+                # Flows that have fallen behind the clock no longer affect ordering.
+                self._finish = {f: t for f, t in self._finish.items() if t > self._vclock[f[0]]}
+            heapq.heappush(self._queues[provider], entry)
+        return entry
+
+    def _wait(self, entry, now):
+        wait = 0.0
+        for requests, tokens in entry.buckets:
+            if requests is not None:
+                wait = max(wait, requests.wait_time(1, now))
+            if tokens is not None:
+                wait = max(wait, tokens.wait_time(entry.cost, now))
+        return wait
+
+    @staticmethod
+    def _take(entry):
+        for requests, tokens in entry.buckets:
+            if requests is not None:
+                requests.take(1)
+            if tokens is not None:
+                tokens.take(entry.cost)
+
+    def _pump(self):
+        granted = []
+        with self._lock:
+            now = time.monotonic()
+            wake = None
+            for provider, queue in self._queues.items():
+                while queue:
+                    entry = queue[0]
+                    if entry.cancelled:
+                        heapq.heappop(queue)
+                        continue
+                    wait = self._wait(entry, now)
+                    if wait > 0:
+                        wake = wait if wake is None else min(wake, wait)
+                        break
+                    heapq.heappop(queue)
+                    self._take(entry)
+                    self._vclock[provider] = entry.tag
+                    self.stats["granted"] += 1
+                    if now - entry.enqueued > 0.001:
+                        self.stats["delayed"] += 1
+                        self.stats["wait_ms"] += round((now - entry.enqueued) * 1000)
+                    granted.append(entry)
+            if wake is not None and (self._wake_at is None or now + wake < self._wake_at):
+                # One timer for the earliest wake-up; later arrivals pump on their own.
+                self._wake_at = now + wake
+                timer = threading.Timer(wake, self._on_timer)
+                timer.daemon = True
+                timer.start()
+        for entry in granted:
+            try:
+                entry.grant()
+            except RuntimeError:
+                # The waiting event loop has already shut down.
+                pass
+
+    def _on_timer(self):
+        with self._lock:
+            if self._wake_at is not None and self._wake_at <= time.monotonic() + 0.001:
+                self._wake_at = None
+        self._pump()
+
+    async def aacquire(self, model_id, messages):
+        entry = self._enqueue(model_id, messages)
+        if entry is None:
+            return
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        entry.grant = lambda: loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None))
+        self._pump()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            entry.cancelled = True
+            raise
+
+    def try_acquire(self, model_id, messages):
+        # Takes a slot only if one is free now and nobody is queued for it.
+        with self._lock:
+            provider, buckets = self.buckets(model_id)
+        if not buckets:
+            return True
+        entry = _Waiter(call_priority(), buckets, call_cost(messages))
+        with self._lock:
+            if any(not e.cancelled for e in self._queues[provider]) or self._wait(entry, time.monotonic()) > 0:
+                return False
+            self._take(entry)
+            self.stats["granted"] += 1
+        return True
+
+    def charge(self, model_id, text):
+        # Completion tokens are only known afterwards; overdraw the token buckets.
+        if not text:
+            return
+        with self._lock:
+            _, buckets = self.buckets(model_id)
+            for _, tokens in buckets:
+                if tokens is not None:
+                    tokens.take(count_tokens(text))
+
+    def throttle(self, model_id):
+        with self._lock:
+            _, buckets = self.buckets(model_id)
+            for requests, _ in buckets:
+                if requests is not None:
+                    requests.drain()
+            self.stats["throttled"] += 1
+
+RATE_LIMITER = RateScheduler()
+
+# ========== SYNC BRIDGE ==========
+# The pipeline is written once, as coroutines. Its sync entry points
+# (model_complete, router, ensemble_reply, run_benchmark, ...) run them on
+# one long-lived event loop in a daemon thread, so the async SDK clients
+# always see the same loop, and carry the caller's contextvars (span tags,
+# usage, session) along. Calling a sync entry point from a running event
+# loop would deadlock; it raises instead. Await the async version there.
+
+_SYNC_LOOP = None
+_SYNC_LOOP_LOCK = threading.Lock()
+_END = object()
+
+def sync_loop():
+    global _SYNC_LOOP
+    with _SYNC_LOOP_LOCK:
+        if _SYNC_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="sync-bridge", daemon=True).start()
+            _SYNC_LOOP = loop
+        return _SYNC_LOOP
+
+def _not_on_loop(aw):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    aw.close()
+    raise RuntimeError("sync pipeline function called from a running event loop; await the async version")
+
+def run_sync(coro):
+    # Runs coro on the bridge loop and returns (or raises) its result.
+    _not_on_loop(coro)
+    loop, result, tasks = sync_loop(), Future(), []
+
+    def settle(task):
+        if task.cancelled():
+            result.cancel()
+        elif task.exception() is not None:
+            result.set_exception(task.exception())
+        else:
+            result.set_result(task.result())
+
+    def start():
+        # Runs in the caller's context, which create_task copies into the task.
+        tasks.append(loop.create_task(coro))
+        tasks[0].add_done_callback(settle)
+
+    loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+    try:
+        return result.result()
+    except BaseException:
+        if tasks and not tasks[0].done():
+            loop.call_soon_threadsafe(tasks[0].cancel)  # e.g. KeyboardInterrupt in the caller
+        raise
+
+def iter_sync(agen):
+    # Drives an async generator from sync code. One task on the bridge loop
+    # owns it, so spans opened inside it stay in one context, and it fetches a
+    # chunk only when the caller asks for the next one. Closing this generator
+    # early closes the async one before returning.
+    _not_on_loop(agen)
+    loop, demand = sync_loop(), asyncio.Queue()
+
+    async def pump():
+        while True:
+            step, fut = await demand.get()
+            try:
+                if step == "close":
+                    await agen.aclose()
+                    fut.set_result(None)
+                    return
+                fut.set_result(await agen.__anext__())
+            except StopAsyncIteration:
+                fut.set_result(_END)
+                return
+            except BaseException as e:
+                fut.set_exception(e)
+                return
+
+    loop.call_soon_threadsafe(lambda: loop.create_task(pump()), context=contextvars.copy_context())
+    finished = False
+    try:
+        while True:
+            fut = Future()
+            loop.call_soon_threadsafe(demand.put_nowait, ("next", fut))
+            try:
+                item = fut.result()
+            except BaseException:
+                finished = True
+                raise
+            if item is _END:
+                finished = True
+                return
+            yield item
+    finally:
+        if not finished:
+            fut = Future()
+            loop.call_soon_threadsafe(demand.put_nowait, ("close", fut))
+            fut.result()
+
+# ========== RESILIENT CALLS ==========
+# Backend calls wait for a RATE_LIMITER slot, then run under a deadline and
+# are retried with jittered exponential backoff. Time in the local queue is
+# not part of the deadline, the latency history or the breaker. Once a model
+# has enough latency history, a call still running after that model's p95
+# gets a duplicate (hedge) if a rate slot is free; the first answer wins.
+# Each model has a circuit breaker: after BREAKER_FAILURES consecutive
+# server-side errors or timeouts it stops taking calls for BREAKER_COOLDOWN
+# seconds, then lets one probe through (again, if that probe is cancelled or
+# ends in a client error). While it is open, calls from a FAILOVER_STAGES span fail
+# over to the next healthy THERAPIST_ENGINES entry on any provider; judge,
+# baseline and other calls stay on their model. Streams get breaker-aware
+# failover and are retried only until their first chunk arrives.
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.consecutive = 0
+            self.opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            self._probing = False
+            if self.consecutive >= self.failures:
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        # The call ended without a verdict on the model (cancelled, or an
+        # error that says nothing about its health); let another probe through.
+        with self._lock:
+            self._probing = False
+
+BREAKERS = defaultdict(CircuitBreaker)
+CALL_LATENCY = defaultdict(lambda: deque(maxlen=500))
+HEDGE_STATS = Counter()
+
+def hedge_delay(model_id):
+    samples = CALL_LATENCY[model_id]
+    if not HEDGE_REQUESTS or len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return Metrics._pct(sorted(samples), 95)
+
+def failover_chain(model_id):
+    # Every backend takes the same chat messages, so therapist calls can move
+    # across providers. A judge that switched models would score twice.
+    if _SPAN.get().get("stage") not in FAILOVER_STAGES:
+        return [model_id]
+    return [model_id, *(m for m in dict.fromkeys(THERAPIST_ENGINES.values()) if m != model_id)]
+
+def pick_model(model_id):
+    for candidate in failover_chain(model_id):
+        if BREAKERS[candidate].allow():
+            return candidate
+    raise CircuitOpenError(f"circuit open for {model_id} and every failover engine")
+
+def status_code(exc):
+    return getattr(exc, "code", None) or getattr(exc, "status_code", None)
+
+def retryable(exc):
+    # Client errors other than timeouts and rate limits will fail the same way again.
+    status = status_code(exc)
+    if isinstance(status, int) and 400 <= status < 500 and status not in (408, 429):
+        return False
+    return not isinstance(exc, (CircuitOpenError, KeyError, TypeError, ValueError, NotImplementedError))
+
+def breaker_fault(exc):
+    # Only server-side errors and timeouts say the model is unhealthy; client
+    # errors, rate limits and local misses (e.g. CassetteMiss) do not.
+    return retryable(exc) and status_code(exc) != 429
+
+def settle_breaker(model_id, exc):
+    if breaker_fault(exc):
+        BREAKERS[model_id].failure()
+    else:
+        BREAKERS[model_id].release()
+
+def backoff(attempt):
+    return RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.0)
+
+async def _ahedged(model_id, attempt_fn, messages):
+    first = asyncio.ensure_future(attempt_fn(model_id))
+    delay = hedge_delay(model_id)
+    if delay is None:
+        return await first
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    if not RATE_LIMITER.try_acquire(model_id, messages):
+        HEDGE_STATS["hedge_throttled"] += 1
+        return await first
+    HEDGE_STATS["hedged"] += 1
+    second = asyncio.ensure_future(attempt_fn(model_id))
+    pending, error = {first, second}, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        HEDGE_STATS["hedge_won"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        first.cancel()
+        second.cancel()
+
+async def acall_resilient(model_id, messages, attempt_fn, *, timeout=CALL_TIMEOUT, retries=CALL_RETRIES):
+    # attempt_fn(model) makes one backend call once its rate slot is granted.
+    # Returns (result, retries, model used, seconds spent in the rate queue).
+    waited = 0.0
+    for attempt in range(retries + 1):
+        chosen = pick_model(model_id)
+        try:
+            queued = time.perf_counter()
+            await RATE_LIMITER.aacquire(chosen, messages)
+            t0 = time.perf_counter()
+            waited += t0 - queued
+            result = await asyncio.wait_for(_ahedged(chosen, attempt_fn, messages), timeout)
+        except Exception as e:
+            settle_breaker(chosen, e)
+            if status_code(e) == 429:
+                RATE_LIMITER.throttle(chosen)
+            if not retryable(e) or attempt == retries:
+                raise
+            await asyncio.sleep(backoff(attempt))
+            continue
+        except BaseException:
+            # Cancelled: a probe that never finished must not hold the breaker.
+            BREAKERS[chosen].release()
+            raise
+        BREAKERS[chosen].success()
+        CALL_LATENCY[chosen].append(time.perf_counter() - t0)
+        return result, attempt, chosen, waited
+
+async def aopen_stream(model_id, messages, params):
+    # Returns (model used, first chunk, rest of the stream, seconds spent in
+    # the rate queue); first is None for an empty stream.
+    waited = 0.0
+    for attempt in range(CALL_RETRIES + 1):
+        chosen = pick_model(model_id)
+        chunks = None
+        try:
+            queued = time.perf_counter()
+            await RATE_LIMITER.aacquire(chosen, messages)
+            waited += time.perf_counter() - queued
+            chunks = backend_for(chosen).astream(chosen, messages, **params)
+            first = await asyncio.wait_for(chunks.__anext__(), CALL_TIMEOUT)
+        except StopAsyncIteration:
+            BREAKERS[chosen].success()
+            return chosen, None, chunks, waited
+        except Exception as e:
+            if chunks is not None:
+                await chunks.aclose()
+            settle_breaker(chosen, e)
+            if status_code(e) == 429:
+                RATE_LIMITER.throttle(chosen)
+            if not retryable(e) or attempt == CALL_RETRIES:
+                raise
+            await asyncio.sleep(backoff(attempt))
+            continue
+        except BaseException:
+            BREAKERS[chosen].release()
+            if chunks is not None:
+                await chunks.aclose()
+            raise
+        BREAKERS[chosen].success()
+        return chosen, first, chunks, waited
+
+# ========== MICRO-BATCHING ==========
+# With many async sessions in flight, requests that share a model, a system
+# prompt (a THERAPISTS entry, the patient prompt, the router) and sampling
+# parameters are held for `window` seconds and sent to Backend.abatch
+# together. A group is flushed early once it reaches `max_batch`. Enable it
+# with enable_batching() or LLM_BATCH_WINDOW_MS.
+
+class MicroBatcher:
+    def __init__(self, window=0.005, max_batch=32):
+        self.window = window
+        self.max_batch = max_batch
+        self.stats = Counter()
+        self._pending = {}
+
+    async def submit(self, model_id, messages, **params):
+        loop = asyncio.get_running_loop()
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        key = (id(loop), model_id, system, json.dumps(params, sort_keys=True, default=str))
+        group = self._pending.get(key)
+        if group is None:
+            group = self._pending[key] = {"model_id": model_id, "params": params, "items": []}
+            loop.call_later(self.window, self._flush, key, group)
+        fut = loop.create_future()
+        submitted = time.perf_counter()
+        group["items"].append((messages, fut))
+        if len(group["items"]) >= self.max_batch:
+            self._flush(key, group)
+        text = await fut
+        return text, group["flushed"] - submitted
+
+    def _flush(self, key, group):
+        # The timer of a group that was already flushed for being full is a no-op.
+        if self._pending.get(key) is not group:
+            return
+        del self._pending[key]
+        group["flushed"] = time.perf_counter()
+        asyncio.ensure_future(self._run(group))
+
+    async def _run(self, group):
+        items = group["items"]
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(items)
+        self.stats["largest"] = max(self.stats["largest"], len(items))
+        try:
+            results = await backend_for(group["model_id"]).abatch(
+                group["model_id"], [messages for messages, _ in items], **group["params"]
+            )
+        except Exception as e:
+            results = [e] * len(items)
+        for (_, fut), res in zip(items, results):
+            if fut.done():
+                continue  # the caller was cancelled meanwhile
+            if isinstance(res, BaseException):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+    def mean_batch_size(self):
+        return self.stats["requests"] / self.stats["batches"] if self.stats["batches"] else None
+
+BATCHER: MicroBatcher | None = None
+
+def enable_batching(window=0.005, max_batch=32) -> MicroBatcher:
+    global BATCHER
+    BATCHER = MicroBatcher(window, max_batch)
+    return BATCHER
+
+def disable_batching():
+    global BATCHER
+    BATCHER = None
+
+if os.getenv("LLM_BATCH_WINDOW_MS"):
+    enable_batching(window=float(os.getenv("LLM_BATCH_WINDOW_MS")) / 1000)
+
+async def model_acomplete(model_id, messages, *, cache=True, **params) -> str:
+    start = time.perf_counter()
+    key = cache_key(cache, model_id, messages, params)
+    if key is not None and (hit := RESPONSE_CACHE.get(key)):
+        record_call(model_id, messages, hit, start, cache_hit=True)
+        return hit
+    async def attempt(m):
+        if BATCHER is not None:
+            reply, queued = await BATCHER.submit(m, messages, **params)
+        else:
+            reply, queued = await backend_for(m).acomplete(m, messages, **params), 0.0
+        RATE_LIMITER.charge(m, reply)
+        return reply, queued
+
+    try:
+        (text, batched), retries, used, waited = await acall_resilient(model_id, messages, attempt)
+    except Exception as e:
+        record_call(model_id, messages, None, start, error=repr(e))
+        raise
+    record_call(used, messages, text, start, queued=waited + batched, retries=retries)
+    if key is not None:
+        RESPONSE_CACHE.put(key, text)
+    return text
+
+def model_complete(model_id, messages, **kwargs) -> str:
+    return run_sync(model_acomplete(model_id, messages, **kwargs))
+
+# A cached stream is replayed as one chunk. A stream the caller abandons is
+# only cached when cache_partial is set: the router stops at its selection
+# tag and everything it needs is already in the partial text.
+async def model_astream(model_id, messages, *, cache=True, cache_partial=False, **params):
+    start = time.perf_counter()
+    key = cache_key(cache, model_id, messages, params)
+    if key is not None and (hit := RESPONSE_CACHE.get(key)):
+        record_call(model_id, messages, hit, start, cache_hit=True)
+        yield hit
+        return
+    parts, finished, error, used, chunks, waited = [], False, None, model_id, None, 0.0
+    try:
+        used, first, chunks, waited = await aopen_stream(model_id, messages, params)
+        if first is not None:
+            parts.append(first)
+            yield first
+            async for piece in chunks:
+                parts.append(piece)
+                yield piece
+        finished = True
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        if chunks is not None:
+            await chunks.aclose()
+        RATE_LIMITER.charge(used, "".join(parts))
+        record_call(used, messages, "".join(parts), start, queued=waited, error=error)
+        if key is not None and parts and (finished or cache_partial):
+            RESPONSE_CACHE.put(key, "".join(parts))
+
+def model_stream(model_id, messages, **kwargs):
+    return iter_sync(model_astream(model_id, messages, **kwargs))
+
+# ========== MODEL CALL WRAPPERS ==========
+def call_together(
+        model_id: str,
+        messages: list[dict],
+        *,
+        max_tokens: int,
+        temperature: float = 0.7,
+        stop: list[str] | None = None,
+        cache: bool = True,
+) -> str:
+    return run_sync(call_together_async(
+        model_id, messages, max_tokens=max_tokens, temperature=temperature, stop=stop, cache=cache,
+    ))
+
+async def call_together_async(
+        model_id: str,
+        messages: list[dict],
+        *,
+        max_tokens: int,
+        temperature: float = 0.7,
+        stop: list[str] | None = None,
+        cache: bool = True,
+) -> str:
+    return await model_acomplete(
+        model_id, messages if isinstance(messages, PromptView) else messages[-HIST_KEEP:], cache=cache,
+        max_tokens=max_tokens, temperature=temperature, stop=stop or STOP_SEQ,
+    )
+
+def call_gemini(
+        messages: list[dict],
+        *,
+        temperature: float = 0.7,
+        cache: bool = True,
+) -> str:
+    return model_complete(GEMINI_MODEL, messages, cache=cache, temperature=temperature)
+
+async def call_gemini_async(
+        messages: list[dict],
+        *,
+        temperature: float = 0.7,
+        cache: bool = True,
+) -> str:
+    return await model_acomplete(GEMINI_MODEL, messages, cache=cache, temperature=temperature)
+
+def stream_gemini(
+        messages: list[dict],
+        *,
+        temperature: float = 0.7,
+        **kwargs,
+):
+    return model_stream(GEMINI_MODEL, messages, temperature=temperature, **kwargs)
+
+async def stream_gemini_async(
+        messages: list[dict],
+        *,
+        temperature: float = 0.7,
+        **kwargs,
+):
+    async with contextlib.aclosing(
+        model_astream(GEMINI_MODEL, messages, temperature=temperature, **kwargs)
+    ) as chunks:
+        async for piece in chunks:
+            yield piece
+
+# ========== LEARNED ROUTER ==========
+# A local stand-in for the LLM router. It uses hashed word unigrams and bigrams
+# of the patient's latest message and one logistic regression per modality
+# (multi-label), trained with plain SGD. Inference is a few dozen dict lookups
+# and takes well under a millisecond on CPU. Training data:
+#   - scenarios in the SCENARIO_CORPUS that carry a modality label
+#   - router decisions logged to ROUTER_LOG_PATH by the LLM router
+# In "learned" mode, router() asks the local model first. It calls the LLM
+# router (ROUTER_FALLBACK_MODE) only when some modality's probability falls
+# in the uncertain band between 1 - ROUTER_CONFIDENCE and ROUTER_CONFIDENCE,
+# or when nothing is selected. It is the default ROUTER_MODE only once
+# `--train-router PATH` has written weights to ROUTER_MODEL_PATH: the few
+# labelled scenarios alone leave it unsure on most messages. Asked for
+# without saved weights, it is trained on first use in a worker thread, as
+# training takes longer the more decisions ROUTER_LOG_PATH holds.
+
+ROUTER_TOKEN_RE = re.compile(r"[a-z']+")
+
+def router_features(text, dim=ROUTER_HASH_DIM):
+    # crc32 rather than hash(): str hashes are salted per process, and saved
+    # weights must mean the same thing in every worker.
+    words = ROUTER_TOKEN_RE.findall(text.lower())
+    grams = words + [a + " " + b for a, b in zip(words, words[1:])]
+    feats = Counter(zlib.crc32(g.encode()) % dim for g in grams)
+    norm = math.sqrt(sum(v * v for v in feats.values())) or 1.0
+    return {i: v / norm for i, v in feats.items()}
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+
+class LocalRouter:
+    def __init__(self, weights=None, bias=None, dim=ROUTER_HASH_DIM):
+        self.dim = dim
+        self.weights = weights or {d: {} for d in THERAPISTS}
+        self.bias = bias or {d: 0.0 for d in THERAPISTS}
+
+    def probabilities(self, text):
+        feats = router_features(text, self.dim)
+        return {
+            d: _sigmoid(self.bias[d] + sum(w.get(i, 0.0) * v for i, v in feats.items()))
+            for d, w in self.weights.items()
+        }
+
+    def predict(self, text, confidence=ROUTER_CONFIDENCE):
+        # Digits string, or None when the model is unsure.
+        probs = self.probabilities(text)
+        if any(1 - confidence < p < confidence for p in probs.values()):
+            return None
+        digits = "".join(d for d, p in sorted(probs.items()) if p >= confidence)
+        return digits or None
+
+    def fit(self, examples, *, epochs=30, lr=0.5, l2=1e-4, seed=0):
+        # examples: [(text, digits), ...]
+        data = [(router_features(text, self.dim), set(digits)) for text, digits in examples]
+        rng = random.Random(seed)
+        for _ in range(epochs):
+            rng.shuffle(data)
+            for feats, labels in data:
+                for d, w in self.weights.items():
+                    z = self.bias[d] + sum(w.get(i, 0.0) * v for i, v in feats.items())
+                    g = _sigmoid(z) - (d in labels)
+                    self.bias[d] -= lr * g
+                    for i, v in feats.items():
+                        w[i] = w.get(i, 0.0) * (1 - lr * l2) - lr * g * v
+        return self
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"dim": self.dim, "bias": self.bias, "weights": self.weights}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        weights = {d: {int(i): v for i, v in w.items()} for d, w in data["weights"].items()}
+        return cls(weights, data["bias"], data["dim"])
+
+def router_examples(log_path=None):
+    # Labelled scenarios plus every logged LLM routing decision.
+    examples = [
+        (record["text"], record["modality"]) for record in scenario_corpus().stream()
+        if record.get("modality")
+    ]
+    log_path = log_path or ROUTER_LOG_PATH
+    if log_path and os.path.exists(log_path):
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue  # torn final line from a crashed writer
+                examples.append((row["text"], row["digits"]))
+    return examples
+
+def train_local_router(log_path=None, **fit_kwargs):
+    return LocalRouter().fit(router_examples(log_path), **fit_kwargs)
+
+_ROUTER_LOG_LOCK = threading.Lock()
+
+def log_router_decision(text, digits):
+    if not ROUTER_LOG_PATH:
+        return
+    line = json.dumps({"text": text, "digits": digits}, ensure_ascii=False) + "\n"
+    with _ROUTER_LOG_LOCK, open(ROUTER_LOG_PATH, "a") as f:
+        f.write(line)
+
+LOCAL_ROUTER = None
+_LOCAL_ROUTER_LOCK = threading.Lock()
+
+def local_router():
+    global LOCAL_ROUTER
+    with _LOCAL_ROUTER_LOCK:
+        if LOCAL_ROUTER is None:
+            if ROUTER_MODEL_PATH and os.path.exists(ROUTER_MODEL_PATH):
+                LOCAL_ROUTER = LocalRouter.load(ROUTER_MODEL_PATH)
+            else:
+                LOCAL_ROUTER = train_local_router()
+        return LOCAL_ROUTER
+
+def learned_route(dialogue):
+    # Local prediction for the latest message, or None to defer to the LLM.
+    with span("router_local"):
+        digits = local_router().predict(dialogue[-1]["content"])
+    ROUTER_STATS["local" if digits else "fallback"] += 1
+    return digits
+
+ROUTER_STATS = Counter()
+
+# ========== AGGREGATION + ENSEMBLE LOGIC ==========
+
+# Prompt builders and the sync entry points of the pipeline. Each sync
+# function is a thin wrapper that runs its async counterpart (ASYNC PIPELINE
+# below) through the SYNC BRIDGE, so the two can never drift apart.
+ROUTER_TAG_RE = re.compile(r"<modalities>\s*(\d+)\s*</modalities>")
+ROUTER_FAST_SUFFIX = (
+    "\nSkip the reasoning. Reply with only the tag, e.g. <modalities>134</modalities>."
+)
+
+# BRAIN_PROMPT split at the patient message: the instructions and examples
+# are a static, cacheable system prefix; only the query changes per turn.
+ROUTER_QUERY_AT = BRAIN_PROMPT.index("Now, analyze the following patient message")
+ROUTER_SYSTEM = BRAIN_PROMPT[:ROUTER_QUERY_AT].strip()
+ROUTER_QUERY = BRAIN_PROMPT[ROUTER_QUERY_AT:]
+
+def router_messages(dialogue, mode=None):
+    mode = mode or ROUTER_MODE
+    content = ROUTER_QUERY.format(user_input=dialogue[-1]['content'])
+    if mode == "fast":
+        content += ROUTER_FAST_SUFFIX
+    return [
+        {"role": "system", "content": ROUTER_SYSTEM, "static": True},
+        {"role": "user", "content": content},
+    ]
+
+def router_params(mode=None):
+    mode = mode or ROUTER_MODE
+    if mode == "fast":
+        # No thinking and a handful of output tokens: the tag is all we need.
+        return {"temperature": 0.0, "max_tokens": 32, "thinking": False, "cache_partial": True}
+    return {"temperature": 0.5, "cache_partial": True}
+
+def parse_router_digits(text):
+    m = ROUTER_TAG_RE.search(text)
+    if m:
+        selection = m.group(1)
+    else:
+        # Untagged answer: use the last standalone number, never digits
+        # scattered through the reasoning.
+        groups = re.findall(r"\b\d+\b", text)
+        selection = groups[-1] if groups else ""
+    return "".join(dict.fromkeys(d for d in selection if d in THERAPISTS)) or "2"
+
+def draft_messages(dialogue, digit):
+    sys_prompt = THERAPISTS[digit][1]
+    return windowed(dialogue, sys_prompt)
+
+def router(dialogue, mode=None):
+    return run_sync(router_async(dialogue, mode))
+
+def draft_one(dialogue, digit, enqueued=None):
+    return run_sync(draft_one_async(dialogue, digit, enqueued))
+
+def drafts(dialogue, digits, *, max_workers=DRAFT_CONCURRENCY, timeout=DRAFT_TIMEOUT):
+    # Drafts that fail or miss the deadline are dropped.
+    return run_sync(drafts_async(dialogue, digits, max_concurrency=max_workers, timeout=timeout))
+
+AGGREGATOR_SYSTEM = (
+    AGGREGATOR_PROMPT + "\nNever use first-person statements as if you are the client. Always write as the therapist."
+)
+
+def aggregator_messages(drafts_dict):
+    # Label each draft for clarity
+    drafts_concat = ""
+    for style, text in drafts_dict.items():
+        drafts_concat += f"[{style} Therapist Draft]:\n{text}\n\n"
+    return [
+        {"role": "system", "content": AGGREGATOR_SYSTEM, "static": True},
+        {"role": "user", "content": drafts_concat}
+    ]
+
+def aggregate_with_gemini(drafts_dict):
+    return run_sync(aggregate_with_gemini_async(drafts_dict))
+
+
+# ========== JUDGING ==========
+# Every (candidate, judge) pair is scored in parallel, so judging N candidates
+# with the AGGREGATOR_MODELS panel takes about as long as one judge call.
+
+JUDGE_PARAMS = {"max_tokens": 128, "temperature": 0.0, "stop": ["}"]}
+JUDGE_SCORE_RE = re.compile(r'"?(\w+)"?\s*:\s*"?(\d+(?:\.\d+)?)')
+
+def judge_messages(dialogue: list[dict], assistant_text: str) -> list[dict]:
+    # Built here rather than in call_together, whose HIST_KEEP slice would
+    # drop the judge's system prompt on long sessions.
+    return list(windowed(dialogue, JUDGE_PROMPT)) + [{"role": "assistant", "content": assistant_text}]
+
+def judge_reply(dialogue: list[dict], assistant_text: str, model_id: str) -> dict | None:
+    return run_sync(judge_reply_async(dialogue, assistant_text, model_id))
+
+def parse_judge_scores(raw: str) -> dict | None:
+    # JSON first (the "}" stop sequence usually eats the closing brace), then
+    # recover any "dimension": score pairs a truncated or chatty reply left.
+    # Scores are clamped to 0-10. A dimension the reply missed takes the mean
+    # of those it scored, so partial verdicts stay on the full scale; None
+    # when no dimension could be recovered.
+    found = {}
+    start = raw.find("{")
+    if start != -1:
+        body = raw[start:]
+        end = body.find("}")
+        try:
+            data = json.loads(body[:end + 1] if end != -1 else body + "}")
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            found = {k: v for k, v in data.items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+    if not all(k in found for k in JUDGE_DIMENSIONS):
+        for k, v in JUDGE_SCORE_RE.findall(raw):
+            found.setdefault(k, float(v))
+    scores = {k: max(0, min(10, int(round(found[k])))) for k in JUDGE_DIMENSIONS if k in found}
+    if not scores:
+        return None
+    mean = sum(scores.values()) / len(scores)
+    return {k: scores.get(k, mean) for k in JUDGE_DIMENSIONS}
+
+def rank_judged(candidates: dict, panel: list, results: list) -> list[dict]:
+    # results is flat, candidate-major: one entry per (candidate, judge).
+    # A judge that errored or returned no usable scores is left out of that
+    # candidate's mean.
+    ranked = []
+    for i, (label, text) in enumerate(candidates.items()):
+        scores = {}
+        for j, name in enumerate(panel):
+            res = results[i * len(panel) + j]
+            if isinstance(res, BaseException):
+                print(f"[judge] {name} failed on {label}: {res!r}")
+            elif res is None:
+                print(f"[judge] {name} gave no scores for {label}")
+            else:
+                scores[name] = res
+        totals = [sum(sc.values()) for sc in scores.values()]
+        ranked.append({
+            "label": label,
+            "text": text,
+            "total": sum(totals) / len(totals) if totals else 0.0,
+            "scores": scores,
+        })
+    ranked.sort(key=lambda r: r["total"], reverse=True)
+    return ranked
+
+def judge_candidates(dialogue, candidates: dict, judges: dict | None = None) -> list[dict]:
+    # candidates maps a label to reply text; returns them best-first with the
+    # mean rubric total across the judge panel.
+    return run_sync(judge_candidates_async(dialogue, candidates, judges))
+
+def best_of_n(dialogue, candidates: dict, judges: dict | None = None) -> dict:
+    return run_sync(best_of_n_async(dialogue, candidates, judges))
+
+def ensemble_reply(dialogue):
+    # Judging several aggregator models against each other is the
+    # "tournament" engine (tournament_reply_async).
+    return run_sync(ensemble_reply_async(dialogue))
+
+# ========== PATIENT SIMULATION + SESSION LOGIC ==========
+
+def patient_messages(dialogue: list[dict], patient_prompt: str) -> list[dict]:
+    return windowed(dialogue, patient_prompt)
+
+def require_patient_prompt(patient_prompt):
+    if not patient_prompt:
+        raise ValueError("patient_prompt is required; build one with scenario_prompt(scenario_text)")
+
+def patient_turn(dialogue: list[dict], patient_prompt: str) -> str:
+    return run_sync(patient_turn_async(dialogue, patient_prompt))
+
+def parse_patient_rating(patient_response: str) -> tuple[int, str]:
+    match = re.search(r"\b([1-9]|10)\b", patient_response)
+    if match:
+        rating = int(match.group(1))
+        explanation = patient_response.strip()
+        return rating, explanation
+    return -1, "No explanation available."
+
+def baseline_messages(dialogue: list[dict]) -> list[dict]:
+    return windowed(dialogue, SYSTEM_PROMPT)
+
+BASELINE_PARAMS = {"temperature": 0.6, "max_tokens": THERA_MAX_TOKENS, "stop": STOP_SEQ}
+
+def baseline_reply(model_id, dialogue):
+    return run_sync(baseline_reply_async(model_id, dialogue))
+
+# ========== STREAMING REPLIES ==========
+# Generators that yield the therapist's reply token chunks as they arrive.
+# The full message is appended to the dialogue once the stream finishes; a
+# consumer that stops early leaves the dialogue untouched.
+
+def ensemble_reply_stream(dialogue):
+    return iter_sync(ensemble_reply_astream(dialogue))
+
+def baseline_reply_stream(model_id, dialogue):
+    return iter_sync(baseline_reply_astream(model_id, dialogue))
+
+OPENING_THERAPIST_PROMPT = (
+    "Before we start, on a scale of 1 to 10, how are you feeling today? "
+    "Please provide a number and briefly explain why."
+)
+FINAL_THERAPIST_PROMPT = (
+    "Before we finish, on a scale of 1 to 10, how do you feel now? "
+    "Please provide a number and briefly explain why."
+)
+
+def run_session_with_ratings(therapist_fn, turns=8, patient_prompt=None, label="Ensemble"):
+    # therapist_fn is an async reply function such as ensemble_reply_async.
+    return run_sync(run_session_with_ratings_async(
+        therapist_fn, turns, verbose=True, patient_prompt=patient_prompt, label=label,
+    ))
+
+def run_session_with_ratings_baseline(model_id, turns=8, patient_prompt=None):
+    return run_session_with_ratings(
+        functools.partial(baseline_reply_async, model_id), turns, patient_prompt, label="Baseline"
+    )
+
+def run_ensemble_session(turns=12, patient_prompt=None):
+    return run_session_with_ratings(ensemble_reply_async, turns, patient_prompt)
+
+# ========== ASYNC PIPELINE ==========
+# The pipeline proper, built on the google-genai and together async clients
+# so one event loop can drive many sessions at once. The sync functions above
+# wrap these.
+
+async def router_async(dialogue, mode=None):
+    mode = mode or ROUTER_MODE
+    if mode == "learned":
+        if LOCAL_ROUTER is None:
+            # Loading or training the model must not stall the event loop.
+            digits = await asyncio.to_thread(learned_route, dialogue)
+        else:
+            digits = learned_route(dialogue)
+        if digits:
+            return digits
+        mode = ROUTER_FALLBACK_MODE
+    with span("router"):
+        if BATCHER is not None:
+            # Batched calls cannot stop at the tag, but share a round-trip with
+            # the other sessions' router calls instead.
+            params = {k: v for k, v in router_params(mode).items() if k != "cache_partial"}
+            text = await model_acomplete(GEMINI_MODEL, router_messages(dialogue, mode), **params)
+        else:
+            text = ""
+            async with contextlib.aclosing(stream_gemini_async(router_messages(dialogue, mode), **router_params(mode))) as chunks:
+                async for piece in chunks:
+                    text += piece
+                    if ROUTER_TAG_RE.search(text):
+                        break
+    digits = parse_router_digits(text)
+    log_router_decision(dialogue[-1]["content"], digits)
+    return digits
+
+async def draft_one_async(dialogue, digit, enqueued=None):
+    with span("draft", modality=THERAPISTS[digit][0], enqueued=enqueued):
+        return await call_gemini_async(draft_messages(dialogue, digit), temperature=0.8)
+
+async def drafts_async(dialogue, digits, *, max_concurrency=DRAFT_CONCURRENCY, timeout=DRAFT_TIMEOUT):
+    digits = list(dict.fromkeys(digits))
+    sem = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def bounded(d):
+        enqueued = time.perf_counter()
+        async with sem:
+            # The timeout starts once the draft holds a slot, so it is truly per draft.
+            return await asyncio.wait_for(draft_one_async(dialogue, d, enqueued), timeout)
+
+    with span("drafts"):
+        results = await asyncio.gather(*(bounded(d) for d in digits), return_exceptions=True)
+    return collect_drafts(digits, results, timeout)
+
+def collect_drafts(digits, results, timeout=DRAFT_TIMEOUT):
+    out = {}
+    for d, res in zip(digits, results):
+        name = THERAPISTS[d][0]
+        if isinstance(res, asyncio.TimeoutError):
+            print(f"[drafts] {name} draft timed out after {timeout:.0f}s, dropping it")
+        elif isinstance(res, BaseException):
+            print(f"[drafts] {name} draft failed, dropping it: {res!r}")
+        else:
+            out[name] = res
+    if not out:
+        raise RuntimeError(f"no drafts completed for modalities {''.join(digits)!r}")
+    return out
+
+# Speculation counters summed over every session in the process.
+SPECULATION_STATS = Counter()
+
+def speculation_hit_rate(stats=SPECULATION_STATS):
+    return stats["hits"] / stats["speculated"] if stats["speculated"] else None
+
+class SpeculativeEnsemble:
+    # Async therapist_fn for one session. While the router is still writing its
+    # reasoning, drafts for a guessed selection (the previous turn's digits, or
+    # `default` on the first turn) are already running; the ones the router
+    # does not confirm are cancelled. The guess is capped at `max_drafts`, and
+    # speculation switches off once `waste_budget` drafts have been thrown away.
+    def __init__(self, max_drafts=SPECULATIVE_MAX_DRAFTS, waste_budget=None, default="2", timeout=DRAFT_TIMEOUT):
+        self.max_drafts = max_drafts
+        self.waste_budget = waste_budget
+        self.default = default
+        self.timeout = timeout
+        self.last_digits = None
+        self.stats = Counter()
+
+    def guess(self):
+        if self.waste_budget is not None and self.stats["wasted"] >= self.waste_budget:
+            return ""
+        return (self.last_digits or self.default)[:self.max_drafts]
+
+    def _draft(self, dialogue, d):
+        return asyncio.create_task(asyncio.wait_for(draft_one_async(dialogue, d), self.timeout))
+
+    def _record(self, **counts):
+        for k, v in counts.items():
+            self.stats[k] += v
+            SPECULATION_STATS[k] += v
+
+    async def __call__(self, dialogue):
+        with span("turn"):
+            guess = self.guess()
+            route = asyncio.create_task(router_async(dialogue))
+            speculative = {d: self._draft(dialogue, d) for d in guess}
+            try:
+                digits = "".join(dict.fromkeys(await route))
+            except BaseException:
+                for t in speculative.values():
+                    t.cancel()
+                raise
+
+            hits = [d for d in guess if d in digits]
+            for d in guess:
+                if d not in digits:
+                    speculative[d].cancel()
+            tasks = {d: speculative.get(d) or self._draft(dialogue, d) for d in digits}
+            self._record(
+                turns=1,
+                speculated=len(guess),
+                hits=len(hits),
+                wasted=len(guess) - len(hits),
+                full_hits=int(bool(guess) and set(digits) <= set(guess)),
+            )
+            self.last_digits = digits
+
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+            agg_reply = await aggregate_with_gemini_async(collect_drafts(digits, results, self.timeout))
+        dialogue.append({"role": "assistant", "content": agg_reply})
+        return agg_reply
+
+async def speculative_reply_async(dialogue):
+    # The "speculative" engine: one SpeculativeEnsemble per Conversation, so
+    # each guess follows that session's previous selection. Stored sessions
+    # are reopened per request, so the selection also goes in their metadata.
+    ensemble = getattr(dialogue, "speculative", None)
+    stored = isinstance(dialogue, Conversation) and dialogue.store is not None
+    if ensemble is None:
+        ensemble = SpeculativeEnsemble()
+        if isinstance(dialogue, Conversation):
+            dialogue.speculative = ensemble
+        if stored:
+            ensemble.last_digits = dialogue.store.meta(dialogue.session_id).get("last_digits")
+    reply = await ensemble(dialogue)
+    if stored:
+        dialogue.store.update_meta(dialogue.session_id, last_digits=ensemble.last_digits)
+    return reply
+
+async def aggregate_with_gemini_async(drafts_dict):
+    with span("aggregate"):
+        return await call_gemini_async(aggregator_messages(drafts_dict))
+
+async def judge_reply_async(dialogue: list[dict], assistant_text: str, model_id: str) -> dict | None:
+    with span("judge"):
+        raw = await model_acomplete(model_id, judge_messages(dialogue, assistant_text), **JUDGE_PARAMS)
+    return parse_judge_scores(raw)
+
+async def judge_candidates_async(dialogue, candidates: dict, judges: dict | None = None) -> list[dict]:
+    judges = judges or AGGREGATOR_MODELS
+    panel = list(judges)
+    results = await asyncio.gather(
+        *(judge_reply_async(dialogue, text, judges[name]) for text in candidates.values() for name in panel),
+        return_exceptions=True,
+    )
+    return rank_judged(candidates, panel, results)
+
+async def best_of_n_async(dialogue, candidates: dict, judges: dict | None = None) -> dict:
+    return (await judge_candidates_async(dialogue, candidates, judges))[0]
+
+async def ensemble_reply_async(dialogue):
+    with span("turn"):
+        digits = await router_async(dialogue)
+        drafts_d = await drafts_async(dialogue, digits)
+        agg_reply = await aggregate_with_gemini_async(drafts_d)
+    dialogue.append({"role": "assistant", "content": agg_reply})
+    return agg_reply
+
+# ========== AGGREGATOR TOURNAMENT ==========
+# Every AGGREGATOR_MODELS entry integrates the same drafts at once. Each reply
+# is judged as soon as it lands; the first to reach `threshold` wins and the
+# slower aggregators are cancelled. At `deadline` the best-scored reply so far
+# is used instead, or the first unjudged reply if none has been scored yet.
+# Contestants run in a "tournament" span, outside FAILOVER_STAGES: a
+# contestant whose breaker is open drops out rather than turning into a
+# second copy of another model under its own label.
+
+async def aggregate_with_model_async(model_id, drafts_dict):
+    with span("tournament"):
+        return await call_together_async(model_id, aggregator_messages(drafts_dict), max_tokens=THERA_MAX_TOKENS)
+
+async def tournament_aggregate_async(dialogue, drafts_dict, *, aggregators=None, judges=None,
+                                     threshold=TOURNAMENT_THRESHOLD, deadline=TOURNAMENT_DEADLINE):
+    aggregators = aggregators or AGGREGATOR_MODELS
+    unjudged = {}
+
+    async def contestant(label, model_id):
+        text = unjudged[label] = await aggregate_with_model_async(model_id, drafts_dict)
+        return (await judge_candidates_async(dialogue, {label: text}, judges))[0]
+
+    tasks = [asyncio.create_task(contestant(label, model_id)) for label, model_id in aggregators.items()]
+    best, decided_by = None, "best_available"
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + deadline
+    pending = set(tasks)
+    try:
+        # A contestant's own timeout is just that contestant failing; only
+        # the tournament deadline stops the others.
+        while pending and decided_by != "threshold":
+            done, pending = await asyncio.wait(
+                pending, timeout=max(0.0, stop_at - loop.time()), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                decided_by = "deadline"
+                break
+            for task in done:
+                if task.exception() is not None:
+                    print(f"[tournament] aggregator failed: {task.exception()!r}")
+                    continue
+                judged = task.result()
+                if best is None or judged["total"] > best["total"]:
+                    best = judged
+                if judged["total"] >= threshold:
+                    best, decided_by = judged, "threshold"
+                    break
+    finally:
+        for t in tasks:
+            t.cancel()
+    if best is None and decided_by == "deadline" and unjudged:
+        label, text = next(iter(unjudged.items()))
+        best = {"label": label, "text": text, "total": None, "scores": {}}
+    if best is None:
+        raise RuntimeError(f"no aggregator produced a judged reply within {deadline:g}s")
+    return {**best, "decided_by": decided_by}
+
+async def tournament_reply_async(dialogue):
+    with span("turn"):
+        digits = await router_async(dialogue)
+        drafts_d = await drafts_async(dialogue, digits)
+        best = await tournament_aggregate_async(dialogue, drafts_d)
+    dialogue.append({"role": "assistant", "content": best["text"]})
+    return best["text"]
+
+async def patient_turn_async(dialogue: list[dict], patient_prompt: str) -> str:
+    with span("patient"):
+        response = await call_gemini_async(patient_messages(dialogue, patient_prompt), temperature=0.8)
+    dialogue.append({"role": "user", "content": response})
+    return response
+
+async def baseline_reply_async(model_id, dialogue):
+    with span("baseline"):
+        response = (await model_acomplete(model_id, baseline_messages(dialogue), **BASELINE_PARAMS)).strip()
+    dialogue.append({"role": "assistant", "content": response})
+    return response
+
+async def astream_into_dialogue(dialogue, chunks):
+    parts = []
+    async for piece in chunks:
+        parts.append(piece)
+        yield piece
+    dialogue.append({"role": "assistant", "content": "".join(parts)})
+
+# The streaming engines open the same spans as their whole-reply versions:
+# the stage tags the calls (and picks failover) while the stream is read.
+async def ensemble_reply_astream(dialogue):
+    with span("turn"):
+        digits = await router_async(dialogue)
+        drafts_d = await drafts_async(dialogue, digits)
+        with span("aggregate"):
+            async for piece in astream_into_dialogue(dialogue, stream_gemini_async(aggregator_messages(drafts_d))):
+                yield piece
+
+async def baseline_reply_astream(model_id, dialogue):
+    with span("baseline"):
+        chunks = model_astream(model_id, baseline_messages(dialogue), **BASELINE_PARAMS)
+        async for piece in astream_into_dialogue(dialogue, chunks):
+            yield piece
+
+async def run_session_with_ratings_async(therapist_fn, turns=8, verbose=False, patient_prompt=None, turn_log=None,
+                                         label=None):
+    # therapist_fn is an async reply function such as ensemble_reply_async.
+    # Transcripts are off by default: interleaved prints from hundreds of
+    # concurrent sessions are unreadable. Pass a list as turn_log to collect
+    # latency and token usage for every therapist turn.
+    require_patient_prompt(patient_prompt)
+    say = print if verbose else (lambda *a: None)
+    if label is not None:
+        say("\n" + "=" * 24, label, "=" * 24)
+    dialogue = new_dialogue() if label is None else new_dialogue(label=label)
+    with session_scope(dialogue.session_id):
+        dialogue.append({"role": "assistant", "content": OPENING_THERAPIST_PROMPT})
+        say("\nTherapist (opening):", OPENING_THERAPIST_PROMPT)
+        patient = await patient_turn_async(dialogue, patient_prompt)
+        say("\nPatient (initial rating):", patient)
+        initial_rating, initial_expl = parse_patient_rating(patient)
+        for turn in range(1, turns):
+            t0 = time.perf_counter()
+            with track_usage() as usage:
+                therapist = await therapist_fn(dialogue)
+            if turn_log is not None:
+                turn_log.append({"turn": turn, "latency_s": round(time.perf_counter() - t0, 4), **usage})
+            say("\nTherapist:", therapist)
+            patient = await patient_turn_async(dialogue, patient_prompt)
+            say("\nPatient:", patient)
+        dialogue.append({"role": "assistant", "content": FINAL_THERAPIST_PROMPT})
+        say("\nTherapist (closing):", FINAL_THERAPIST_PROMPT)
+        patient = await patient_turn_async(dialogue, patient_prompt)
+        say("\nPatient (final rating):", patient)
+        final_rating, final_expl = parse_patient_rating(patient)
+        if label is not None:
+            say("\n" + "=" * 60)
+        return initial_rating, final_rating
+
+async def run_ensemble_session_async(turns=12, verbose=False, patient_prompt=None):
+    return await run_session_with_ratings_async(ensemble_reply_async, turns, verbose, patient_prompt)
+
+# ========== FUSED DRAFTING ==========
+# One-call alternative to router -> k drafts -> aggregate. The selected
+# THERAPISTS prompts go into a single structured system prompt. The model
+# writes a short draft per modality and then the integrated reply, all in one
+# generation that reads the dialogue once. With a single modality, that
+# modality's own prompt answers directly and nothing is aggregated. The
+# engine is chosen per session: Conversation.engine, a session's "engine"
+# metadata in the server, or ENSEMBLE_ENGINE by default.
+
+# The aggregator's style rules without its output format: here the reply is
+# one block of a larger, tagged answer.
+FUSED_INTEGRATION = '''
+- Always write as the therapist; never use first-person statements as if you are the client.
+- Focus on the client's main feelings, needs, and goals.
+- Synthesize the most *clinically relevant* and *emotionally resonant* elements of your drafts into a single, seamless reply; do **not** force in every style.
+- If drafts repeat the same point, keep the most effective version. Gently blend insights (e.g., a reflective question from one with a validation from another).
+- Favor empathy, specificity, and practical support that matches the client's needs and language.
+- Write as a single, wise, compassionate therapist in a clear, human voice: never a list, bullet points, headers, or a collage of separate perspectives.
+- Never mention drafts, styles, techniques, specific therapy types, "aggregation" or "integration".
+- Be concise (under 160 words) and end on a natural, supportive note, such as an open-ended question or gentle reflection.
+'''
+
+FUSED_PROMPT = '''
+You are one expert therapist who draws on several evidence-based modalities at once.
+Below are the guidelines for each modality selected for this turn, in order of importance.
+
+{modalities}
+
+**Your task:**
+1. For each modality above, in the same order, write a brief draft (at most 60 words) of how that therapist would reply to the client's latest message, inside <draft modality="name">...</draft>.
+2. Then write the final reply inside <reply>...</reply>, following these rules:
+{integration}
+Write nothing after </reply>.
+'''
+
+FUSED_REPLY_RE = re.compile(r"<reply>\s*(.*?)\s*(?:</reply>|$)", re.S)
+FUSED_DRAFT_RE = re.compile(r"<draft[^>]*>.*?(?:</draft>|$)", re.S)
+
+@functools.lru_cache(maxsize=64)
+def fused_system(digits):
+    # One prompt per modality selection, so each selection is a stable,
+    # cacheable prefix.
+    sections = "\n\n".join(
+        f'### Modality "{THERAPISTS[d][0]}"\n{THERAPISTS[d][1].strip()}' for d in digits
+    )
+    return FUSED_PROMPT.format(modalities=sections, integration=FUSED_INTEGRATION.strip())
+
+def fused_messages(dialogue, digits):
+    if len(digits) == 1:
+        return draft_messages(dialogue, digits)
+    return windowed(dialogue, fused_system(digits))
+
+def parse_fused_reply(text):
+    m = FUSED_REPLY_RE.search(text)
+    if m and m.group(1):
+        return m.group(1).strip()
+    # No reply block: keep whatever is not a draft, else the last draft's body.
+    rest = FUSED_DRAFT_RE.sub("", text).strip()
+    if rest:
+        return rest
+    drafts_found = re.findall(r"<draft[^>]*>(.*?)(?:</draft>|$)", text, re.S)
+    return drafts_found[-1].strip() if drafts_found else text.strip()
+
+def fused_digits(digits):
+    return "".join(dict.fromkeys(digits)) or "2"
+
+async def fused_reply_async(dialogue):
+    with span("turn"):
+        digits = fused_digits(await router_async(dialogue))
+        with span("fused", modality="+".join(THERAPISTS[d][0] for d in digits)):
+            raw = await call_gemini_async(fused_messages(dialogue, digits), temperature=0.8)
+    reply = raw.strip() if len(digits) == 1 else parse_fused_reply(raw)
+    dialogue.append({"role": "assistant", "content": reply})
+    return reply
+
+async def fused_reply_astream(dialogue):
+    # Streams only what is inside <reply>; the drafts are held back.
+    with span("turn"):
+        digits = fused_digits(await router_async(dialogue))
+        with span("fused", modality="+".join(THERAPISTS[d][0] for d in digits)):
+            chunks = stream_gemini_async(fused_messages(dialogue, digits), temperature=0.8)
+            if len(digits) == 1:
+                async for piece in astream_into_dialogue(dialogue, chunks):
+                    yield piece
+                return
+            raw, sent = "", 0
+            async with contextlib.aclosing(chunks) as chunks:
+                async for piece in chunks:
+                    raw += piece
+                    start = raw.find("<reply>")
+                    if start < 0:
+                        continue
+                    body = raw[start + len("<reply>"):]
+                    end = body.find("</reply>")
+                    # Hold back a partial closing tag until the next chunk settles it.
+                    ready = body[:end] if end >= 0 else body[:max(len(body) - len("</reply>"), 0)]
+                    if len(ready) > sent:
+                        text = ready[sent:]
+                        if sent == 0:
+                            text = text.lstrip()
+                        if text:
+                            yield text
+                        sent = len(ready)
+                    if end >= 0:
+                        break
+            reply = parse_fused_reply(raw)
+            if sent == 0 and reply:
+                yield reply  # the model skipped the reply tags
+            dialogue.append({"role": "assistant", "content": reply})
+
+def fused_reply(dialogue):
+    return run_sync(fused_reply_async(dialogue))
+
+async def whole_reply_astream(reply_fn, dialogue):
+    # Stream adapter for engines that only produce a finished reply.
+    yield await reply_fn(dialogue)
+
+ENGINES = {
+    "multi": ensemble_reply_async,
+    "fused": fused_reply_async,
+    "speculative": speculative_reply_async,
+    "tournament": tournament_reply_async,
+}
+STREAM_ENGINES = {
+    "multi": ensemble_reply_astream,
+    "fused": fused_reply_astream,
+    "speculative": functools.partial(whole_reply_astream, speculative_reply_async),
+    "tournament": functools.partial(whole_reply_astream, tournament_reply_async),
+}
+
+def dialogue_engine(dialogue, override=None):
+    engine = override or getattr(dialogue, "engine", None) or ENSEMBLE_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"unknown engine {engine!r}; expected one of {sorted(ENGINES)}")
+    return engine
+
+async def engine_reply_async(dialogue):
+    return await ENGINES[dialogue_engine(dialogue)](dialogue)
+
+# ========== SCENARIO CORPUS ==========
+# Scenarios are read from a JSONL corpus through a sidecar offset index,
+# <corpus>.idx (JSON). It holds the byte offset of every record, a map from
+# scenario id to record number, and for each tag the record numbers that carry
+# it. Tag filters, sampling and sharding work on record numbers, so only the
+# selected records are read and parsed. A corpus of tens of thousands of
+# synthetic patients is never loaded whole. The index is rebuilt whenever the
+# corpus changes size or mtime.
+
+class ScenarioCorpus:
+    def __init__(self, path=None):
+        self.path = path or SCENARIO_CORPUS
+        self.index_path = self.path + ".idx"
+        self._index = None
+        self._lock = threading.Lock()
+
+    def index(self) -> dict:
+        st = os.stat(self.path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            if self._index is None or self._index["stamp"] != stamp:
+                try:
+                    with open(self.index_path) as f:
+                        index = json.load(f)
+                except (OSError, ValueError):
+                    index = None
+                if not index or index.get("stamp") != stamp:
+                    index = self._build(stamp)
+                self._index = index
+            return self._index
+
+    def _build(self, stamp) -> dict:
+        offsets, ids, tags = [], {}, defaultdict(list)
+        pos = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    ids[str(record["id"])] = len(offsets)
+                    for tag in record.get("tags", ()):
+                        tags[tag].append(len(offsets))
+                    offsets.append(pos)
+                pos += len(line)
+        index = {"stamp": stamp, "offsets": offsets, "ids": ids, "tags": tags}
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp, self.index_path)  # atomic, so concurrent builders are harmless
+        except OSError:
+            pass  # read-only checkout: keep the index in memory only
+        print(f"[corpus] indexed {len(offsets)} scenarios in {self.path}")
+        return index
+
+    def __len__(self):
+        return len(self.index()["offsets"])
+
+    def tags(self) -> dict:
+        return {tag: len(numbers) for tag, numbers in self.index()["tags"].items()}
+
+    def select(self, tags=None, sample=None, seed=0, shard=None, limit=None) -> list:
+        # Record numbers in corpus order: any of `tags`, then a seeded sample
+        # of `sample`, then shard (k, n) keeps every n-th starting at k, then
+        # the first `limit`. Workers sharing a seed get disjoint shards.
+        index = self.index()
+        if tags:
+            numbers = sorted(set().union(*(index["tags"].get(tag, ()) for tag in tags)))
+        else:
+            numbers = list(range(len(index["offsets"])))
+        if sample is not None and sample < len(numbers):
+            numbers = sorted(random.Random(seed).sample(numbers, sample))
+        if shard:
+            k, n = shard
+            numbers = numbers[k::n]
+        return numbers[:limit]
+
+    def read(self, numbers):
+        offsets = self.index()["offsets"]
+        with open(self.path, "rb") as f:
+            for n in numbers:
+                f.seek(offsets[n])
+                yield json.loads(f.readline())
+
+    def stream(self, **kwargs):
+        # Lazily yields the records select(**kwargs) picks.
+        return self.read(self.select(**kwargs))
+
+    def get(self, scenario_id) -> dict:
+        n = self.index()["ids"].get(str(scenario_id))
+        if n is None:
+            raise KeyError(scenario_id)
+        return next(self.read([n]))
+
+SCENARIOS = None
+_SCENARIOS_LOCK = threading.Lock()
+
+def scenario_corpus() -> ScenarioCorpus:
+    global SCENARIOS
+    with _SCENARIOS_LOCK:
+        if SCENARIOS is None:
+            SCENARIOS = ScenarioCorpus()
+        return SCENARIOS
+
+def __getattr__(name):
+    # PATIENT_SCENARIOS used to be a list in this module; callers reading
+    # agent_v1.PATIENT_SCENARIOS get the corpus texts in order.
+    if name == "PATIENT_SCENARIOS":
+        return [record["text"] for record in scenario_corpus().stream()]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# ========== SCENARIO RUNNER ==========
+
+async def run_scenarios_async(scenarios, *, therapist_fn=None, make_therapist=None, turns=8,
+                              concurrency=SCENARIO_CONCURRENCY, start=1):
+    # Each session gets its own patient prompt, so nothing is shared between
+    # sessions and they can run side by side on one event loop. Stateful
+    # therapists such as SpeculativeEnsemble are passed as make_therapist so
+    # every session gets a fresh instance. scenarios may be corpus records or
+    # plain texts (numbered from start), and may be a lazy iterator such as
+    # ScenarioCorpus.stream(): `concurrency` workers pull from it as they go.
+    therapist_fn = therapist_fn or ensemble_reply_async
+    make_therapist = make_therapist or (lambda: therapist_fn)
+
+    async def one(idx, scenario):
+        t0 = time.perf_counter()
+        row = {"scenario": idx, "text": scenario, "turns": []}
+        try:
+            initial, final = await run_session_with_ratings_async(
+                make_therapist(), turns, patient_prompt=scenario_prompt(scenario), turn_log=row["turns"]
+            )
+            row.update(initial_rating=initial, final_rating=final, error=None)
+        except Exception as e:
+            row.update(initial_rating=-1, final_rating=-1, error=repr(e))
+        row["seconds"] = round(time.perf_counter() - t0, 3)
+        print(f"[scenario {idx}] {row['initial_rating']} -> {row['final_rating']}"
+              + (f" ({row['error']})" if row["error"] else ""))
+        return row
+
+    pending = enumerate(scenarios)
+    rows = []
+
+    async def worker():
+        for pos, scenario in pending:
+            if isinstance(scenario, dict):
+                rows.append((pos, await one(scenario["id"], scenario["text"])))
+            else:
+                rows.append((pos, await one(start + pos, scenario)))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return scenario_report([row for _, row in sorted(rows, key=lambda r: r[0])], time.perf_counter() - t0)
+
+def run_scenarios(scenarios, **kwargs):
+    return run_sync(run_scenarios_async(scenarios, **kwargs))
+
+def scenario_report(rows, elapsed):
+    # A rating of -1 means the patient never gave a parsable number; keep those
+    # rows in the report but out of the averages.
+    rated = [r for r in rows if r["error"] is None and r["initial_rating"] > 0 and r["final_rating"] > 0]
+    turns = [t for r in rows for t in r.get("turns", ())]
+    latencies = sorted(t["latency_s"] for t in turns)
+    mean = lambda xs: round(sum(xs) / len(xs), 3) if xs else None
+    pct = lambda q: round(Metrics._pct(latencies, q), 3) if latencies else None
+    return {
+        "summary": {
+            "scenarios": len(rows),
+            "rated": len(rated),
+            "failed": sum(1 for r in rows if r["error"] is not None),
+            "mean_initial": mean([r["initial_rating"] for r in rated]),
+            "mean_final": mean([r["final_rating"] for r in rated]),
+            "mean_delta": mean([r["final_rating"] - r["initial_rating"] for r in rated]),
+            "turns": len(turns),
+            "turn_p50_s": pct(50),
+            "turn_p95_s": pct(95),
+            "turn_p99_s": pct(99),
+            "mean_turn_s": mean(latencies),
+            "mean_calls_per_turn": mean([t.get("calls", 0) for t in turns]),
+            "mean_prompt_tokens_per_turn": mean([t.get("prompt_tokens", 0) for t in turns]),
+            "mean_cached_tokens_per_turn": mean([t.get("cached_tokens", 0) for t in turns]),
+            "mean_completion_tokens_per_turn": mean([t.get("completion_tokens", 0) for t in turns]),
+            "therapist_tokens": sum(t.get("prompt_tokens", 0) + t.get("completion_tokens", 0) for t in turns),
+            "elapsed_seconds": round(elapsed, 3),
+        },
+        "results": rows,
+    }
+
+
+# ========== BENCHMARK ==========
+# Runs the ensemble and every BASELINE_MODELS entry over the same scenarios
+# and compares rating deltas, per-turn latency and therapist token use. Arms
+# run one after another so they do not compete for the same quota. With
+# mock=True everything is answered by MockBackend, fully offline.
+
+def benchmark_arms(baselines=None, include_ensemble=True, engines=("multi",)) -> dict:
+    # Arm name -> factory returning a fresh async therapist_fn per session.
+    arms = {}
+    if include_ensemble:
+        for engine in engines:
+            if engine not in ENGINES:
+                raise ValueError(f"unknown engine {engine!r}; expected one of {sorted(ENGINES)}")
+            arms["ensemble" if engine == "multi" else f"ensemble:{engine}"] = lambda e=engine: ENGINES[e]
+    for label, model_id in (BASELINE_MODELS if baselines is None else baselines).items():
+        arms[f"baseline:{label}"] = lambda m=model_id: functools.partial(baseline_reply_async, m)
+    return arms
+
+async def run_benchmark_async(scenarios, *, arms=None, turns=8, concurrency=SCENARIO_CONCURRENCY, start=1):
+    arms = benchmark_arms() if arms is None else arms
+    scenarios = list(scenarios)  # every arm runs the same scenarios
+    report = {"scenarios": len(scenarios), "turns": turns, "arms": {}}
+    for name, make_therapist in arms.items():
+        print(f"\n########## ARM {name} ##########")
+        report["arms"][name] = await run_scenarios_async(
+            scenarios, make_therapist=make_therapist, turns=turns, concurrency=concurrency, start=start
+        )
+    report["comparison"] = {name: arm["summary"] for name, arm in report["arms"].items()}
+    return report
+
+def run_benchmark(scenarios, *, mock=False, **kwargs):
+    if mock:
+        use_mock_backend()
+    return run_sync(run_benchmark_async(scenarios, **kwargs))
+
+def format_comparison(report) -> str:
+    cols = (
+        ("mean_delta", "rating_delta"), ("turn_p50_s", "turn_p50_s"), ("turn_p95_s", "turn_p95_s"),
+        ("mean_calls_per_turn", "calls/turn"), ("mean_prompt_tokens_per_turn", "prompt_tok/turn"),
+        ("mean_cached_tokens_per_turn", "cached_tok/turn"),
+        ("mean_completion_tokens_per_turn", "compl_tok/turn"), ("failed", "failed"),
+    )
+    lines = ["arm".ljust(24) + "".join(label.rjust(16) for _, label in cols)]
+    for name, summary in report["comparison"].items():
+        lines.append(name[:24].ljust(24) + "".join(str(summary[key]).rjust(16) for key, _ in cols))
+    return "\n".join(lines)
+
+# ========== HTTP SERVING ==========
+# A plain ASGI app: run it with `python agent_v1.py --serve --workers N`,
+# or point any ASGI server at agent_v1:app. Routes:
+#   POST /sessions                  {"meta": {...}}               -> {"session_id"}
+#   GET  /sessions/{id}                                           -> metadata and recent messages
+#   POST /sessions/{id}/reply       {"message", "mode", "model", "stream"}
+#   GET  /healthz
+# mode is "ensemble" (default) or "baseline", with model set to a
+# BASELINE_MODELS name or model id. An ensemble session uses the "engine" given
+# in its create-time meta (an ENGINES name); a reply body may override it.
+# Meta "summarize" (default SUMMARIZE_HISTORY) turns on the running summary of
+# turns that leave the window. With "stream": true the reply arrives as
+# server-sent events. At most SERVER_MAX_INFLIGHT replies run at once per
+# worker; up to SERVER_MAX_QUEUE more wait up to SERVER_QUEUE_TIMEOUT seconds,
+# and anything beyond that gets a 503 with Retry-After. Streams are written
+# only as fast as the client reads them. With SESSION_DB set, every request
+# reloads its session from the store, so any worker can serve any session.
+# Without it, sessions live in the worker's memory. Replies to one session
+# are serialized within a worker; across workers, route a session to one
+# worker (sticky sessions).
+
+class Overloaded(Exception):
+    pass
+
+class HTTPError(Exception):
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+class Admission:
+    def __init__(self, limit=SERVER_MAX_INFLIGHT, queue=SERVER_MAX_QUEUE, timeout=SERVER_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.inflight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._sem = asyncio.Semaphore(limit)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if not self._sem.locked():
+            await self._sem.acquire()  # free slot: returns without suspending
+        else:
+            await self._wait_for_slot()
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self._sem.release()
+
+    async def _wait_for_slot(self):
+        if self.waiting >= self.queue:
+            self.rejected += 1
+            raise Overloaded()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded() from None
+        finally:
+            self.waiting -= 1
+
+ADMISSION = Admission()
+_LOCAL_SESSIONS = {}
+_SESSION_LOCKS = weakref.WeakValueDictionary()
+
+def session_lock(session_id):
+    lock = _SESSION_LOCKS.get(session_id)
+    if lock is None:
+        lock = _SESSION_LOCKS[session_id] = asyncio.Lock()
+    return lock
+
+def server_create_session(meta=None):
+    if SESSION_STORE is not None:
+        return SESSION_STORE.create(meta={"summarize": SUMMARIZE_HISTORY, **(meta or {})})
+    session_id = uuid.uuid4().hex
+    meta = meta or {}
+    dialogue = _LOCAL_SESSIONS[session_id] = Conversation(
+        summarizer=summarize_turns if meta.get("summarize", SUMMARIZE_HISTORY) else None
+    )
+    dialogue.engine = meta.get("engine")
+    return session_id
+
+def server_dialogue(session_id):
+    if SESSION_STORE is not None:
+        if not SESSION_STORE.exists(session_id):
+            raise HTTPError(404, "unknown session")
+        return SESSION_STORE.open(session_id)
+    if session_id not in _LOCAL_SESSIONS:
+        raise HTTPError(404, "unknown session")
+    return _LOCAL_SESSIONS[session_id]
+
+def reply_fns(body, dialogue):
+    # (whole-reply coroutine fn, streaming fn) for the requested mode. The
+    # ensemble engine comes from the body, else the session's own setting.
+    mode = body.get("mode", "ensemble")
+    if mode == "ensemble":
+        try:
+            engine = dialogue_engine(dialogue, body.get("engine"))
+        except ValueError as e:
+            raise HTTPError(400, str(e)) from None
+        return ENGINES[engine], STREAM_ENGINES[engine]
+    if mode == "baseline":
+        model = body.get("model") or next(iter(BASELINE_MODELS.values()))
+        model_id = BASELINE_MODELS.get(model, model)
+        if model_id not in known_models():
+            raise HTTPError(400, f"unknown model {model!r}")
+        return functools.partial(baseline_reply_async, model_id), functools.partial(baseline_reply_astream, model_id)
+    raise HTTPError(400, f"unknown mode {mode!r}")
+
+async def read_json(receive, limit=SERVER_MAX_BODY):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "client disconnected")
+        body += message.get("body", b"")
+        if len(body) > limit:
+            raise HTTPError(413, "request body too large")
+        if not message.get("more_body"):
+            break
+    if not body:
+        return {}
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPError(400, "body is not valid JSON") from None
+    if not isinstance(data, dict):
+        raise HTTPError(400, "body must be a JSON object")
+    return data
+
+async def send_json(send, status, payload, headers=()):
+    data = json.dumps(payload, ensure_ascii=False).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": data})
+
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+async def handle_reply(session_id, body, send):
+    message = body.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise HTTPError(400, "message must be a non-empty string")
+    async with ADMISSION.slot(), session_lock(session_id):
+        dialogue = server_dialogue(session_id)
+        reply_fn, stream_fn = reply_fns(body, dialogue)
+        # The user message is logged together with the reply, so a failed
+        # reply leaves nothing behind for a retry to duplicate.
+        with session_scope(session_id), dialogue.pending() as mark:
+            dialogue.append({"role": "user", "content": message})
+            if not body.get("stream"):
+                t0 = time.perf_counter()
+                reply = await reply_fn(dialogue)
+                await send_json(send, 200, {
+                    "session_id": session_id, "reply": reply, "latency_s": round(time.perf_counter() - t0, 4),
+                })
+                return
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+            })
+            parts = []
+            async with contextlib.aclosing(stream_fn(dialogue)) as chunks:
+                try:
+                    async for piece in chunks:
+                        parts.append(piece)
+                        await send({"type": "http.response.body", "body": sse("delta", {"text": piece}), "more_body": True})
+                    final = sse("done", {"session_id": session_id, "reply": "".join(parts)})
+                except Exception as e:
+                    # Headers are already out; report the failure in-band.
+                    final = sse("error", {"detail": repr(e)})
+                    del dialogue[mark:]
+            await send({"type": "http.response.body", "body": final})
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await receive()
+        await send({"type": "lifespan.startup.complete"})
+        await receive()
+        await send({"type": "lifespan.shutdown.complete"})
+        return
+    if scope["type"] != "http":
+        return
+    method, parts = scope["method"], [p for p in scope["path"].split("/") if p]
+    try:
+        if parts == ["healthz"] and method == "GET":
+            await send_json(send, 200, {
+                "status": "ok", "inflight": ADMISSION.inflight, "waiting": ADMISSION.waiting,
+                "rejected": ADMISSION.rejected, "store": SESSION_STORE is not None,
+            })
+        elif parts == ["sessions"] and method == "POST":
+            body = await read_json(receive)
+            await send_json(send, 201, {"session_id": server_create_session(body.get("meta"))})
+        elif len(parts) == 2 and parts[0] == "sessions" and method == "GET":
+            dialogue = server_dialogue(parts[1])
+            meta = SESSION_STORE.meta(parts[1]) if SESSION_STORE is not None else {"messages": len(dialogue)}
+            await send_json(send, 200, {"session_id": parts[1], **meta, "recent": list(dialogue[-HIST_KEEP:])})
+        elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "reply" and method == "POST":
+            await handle_reply(parts[1], await read_json(receive), send)
+        else:
+            raise HTTPError(404, "not found")
+    except HTTPError as e:
+        await send_json(send, e.status, {"detail": e.detail})
+    except Overloaded:
+        await send_json(send, 503, {"detail": "server busy"}, headers=[(b"retry-after", b"1")])
+    except Exception as e:
+        traceback.print_exc()
+        await send_json(send, 500, {"detail": repr(e)})
+
+def serve(host="127.0.0.1", port=8000, workers=1):
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("serving needs an ASGI server: pip install uvicorn")
+    if workers > 1 and SESSION_STORE is None:
+        print("warning: without SESSION_DB each worker keeps its own sessions; set it to share them")
+    uvicorn.run("agent_v1:app", host=host, port=port, workers=workers)
+
+# ========== STARTUP ==========
+# Importing the module must stay cheap: no SDK imports, no clients, no
+# training or file I/O beyond optional config. Anything heavier belongs
+# behind a first-use accessor (see sdk(), the backend clients, local_router()).
+
+def import_time_report(runs=3, top=8):
+    # Best-of-N cold import in fresh interpreters, plus the slowest modules
+    # from -X importtime. Returns the best total in milliseconds.
+    import subprocess, sys
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [here, os.environ.get("PYTHONPATH")]))}
+    best, rows = None, []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import agent_v1"],
+            env=env, capture_output=True, text=True, check=True,
+        ).stderr
+        rows = [line.split("|") for line in out.splitlines() if line.startswith("import time:") and "self" not in line]
+        total = next(int(r[1]) for r in rows if r[2].strip() == "agent_v1") / 1000
+        best = total if best is None else min(best, total)
+    print(f"import agent_v1: {best:.1f} ms (budget {IMPORT_BUDGET_MS} ms)")
+    for r in sorted(rows, key=lambda r: -int(r[0].split(":")[1]))[:top]:
+        print(f"  {int(r[0].split(':')[1]) / 1000:7.1f} ms  {r[2].strip()}")
+    return best
+
+# ========== MAIN ENTRY ==========
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Ensemble vs baseline therapy benchmark")
+    parser.add_argument("--corpus", help="scenario corpus (JSONL) to use instead of SCENARIO_CORPUS")
+    parser.add_argument("--tags", help="comma-separated tags; only scenarios carrying any of them")
+    parser.add_argument("--sample", type=int, default=None, help="a seeded random sample of N scenarios")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shard", default=None, help="K/N: this worker's share of the selected scenarios")
+    parser.add_argument("--limit", type=int, default=None, help="only the first N scenarios")
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=SCENARIO_CONCURRENCY)
+    parser.add_argument("--ensemble-only", action="store_true", help="skip the BASELINE_MODELS arms")
+    parser.add_argument("--engines", default="multi", help="comma-separated ensemble engines to run: " + ",".join(ENGINES))
+    parser.add_argument("--router-mode", choices=("learned", "reason", "fast"), help="override ROUTER_MODE")
+    parser.add_argument("--mock", action="store_true", help="answer every model call with the local mock backend")
+    parser.add_argument("--record", metavar="CASSETTE", help="record every model call to this cassette file")
+    parser.add_argument("--replay", metavar="CASSETTE", help="answer every model call from this cassette file")
+    parser.add_argument("--realtime", action="store_true", help="replay with the recorded latency instead of none")
+    parser.add_argument("--out", default="scenario_report.json")
+    parser.add_argument("--serve", action="store_true", help="run the HTTP server instead of the benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--import-time", action="store_true",
+                        help="measure a cold import of this module and check it against IMPORT_BUDGET_MS")
+    parser.add_argument("--train-router", metavar="PATH",
+                        help="train the learned router from ROUTER_LOG_PATH and the scenario labels, save it to PATH")
+    args = parser.parse_args()
+
+    if args.import_time:
+        raise SystemExit(0 if import_time_report() <= IMPORT_BUDGET_MS else 1)
+
+    if args.train_router:
+        examples = router_examples()
+        LocalRouter().fit(examples).save(args.train_router)
+        print(f"trained the learned router on {len(examples)} examples -> {args.train_router}")
+        raise SystemExit
+
+    if args.router_mode:
+        ROUTER_MODE = os.environ["ROUTER_MODE"] = args.router_mode  # the server re-imports this module
+
+    if args.record or args.replay:
+        os.environ["LLM_CASSETTE"] = args.record or args.replay
+        os.environ["LLM_CASSETTE_MODE"] = "record" if args.record else "replay"
+        os.environ["LLM_CASSETTE_REALTIME"] = "1" if args.realtime else "0"
+
+    if args.serve:
+        if args.mock:
+            os.environ["LLM_BACKEND"] = "mock"  # the server re-imports this module
+        serve(args.host, args.port, args.workers)
+        raise SystemExit
+
+    if args.mock:
+        use_mock_backend()
+    if args.record or args.replay:
+        use_cassette(os.environ["LLM_CASSETTE"], os.environ["LLM_CASSETTE_MODE"], realtime=args.realtime)
+
+    corpus = ScenarioCorpus(args.corpus) if args.corpus else scenario_corpus()
+    scenarios = corpus.stream(
+        tags=args.tags.split(",") if args.tags else None,
+        sample=args.sample,
+        seed=args.seed,
+        shard=tuple(int(x) for x in args.shard.split("/")) if args.shard else None,
+        limit=args.limit,
+    )
+
+    print("\n### COMPARISON: Ensemble (various engines) vs Baselines ###\n")
+    report = run_benchmark(
+        scenarios,
+        arms=benchmark_arms(baselines={} if args.ensemble_only else None, engines=args.engines.split(",")),
+        turns=args.turns,
+        concurrency=args.concurrency,
+    )
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print()
+    print(format_comparison(report))
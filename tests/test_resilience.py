@@ -0,0 +1,38 @@
+import asyncio
+
+import agent_v1
+
+
+def tripped_breaker(model_id):
+    agent_v1.use_mock_backend(latency=0.5, jitter=0.0)
+    breaker = agent_v1.BREAKERS[model_id] = agent_v1.CircuitBreaker(failures=1, cooldown=0.05)
+    breaker.failure()
+    return breaker
+
+
+def test_cancelled_probe_releases_the_breaker():
+    model_id = agent_v1.GEMINI_MODEL
+    breaker = tripped_breaker(model_id)
+
+    async def main():
+        await asyncio.sleep(0.06)
+        probe = asyncio.ensure_future(agent_v1.model_acomplete(model_id, [{"role": "user", "content": "probe"}], cache=False))
+        await asyncio.sleep(0.05)
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        assert not breaker._probing
+        # The next call is let through as a probe and closes the breaker.
+        await agent_v1.model_acomplete(model_id, [{"role": "user", "content": "next"}], cache=False)
+
+    asyncio.run(main())
+    assert breaker.state == "closed"
+
+
+def test_client_errors_do_not_open_the_breaker():
+    model_id = agent_v1.GEMINI_MODEL
+    breaker = agent_v1.BREAKERS[model_id] = agent_v1.CircuitBreaker(failures=1)
+    for exc in (agent_v1.CassetteMiss("x"), ValueError("bad request")):
+        agent_v1.settle_breaker(model_id, exc)
+    assert breaker.state == "closed"
+    agent_v1.settle_breaker(model_id, asyncio.TimeoutError())
+    assert breaker.state == "open"